@@ -1,2 +1,2 @@
-from .kaggle import kaggle_cnn
+from .kaggle import kaggle_cnn, kaggle_cnn_streaming, kaggle_cnn_streaming_state_shapes, kaggle_cnn_time_stride
 from .projection_head import projection_head
\ No newline at end of file
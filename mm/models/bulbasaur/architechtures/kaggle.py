@@ -1,4 +1,27 @@
 import tensorflow as tf
+from typing import Dict, List, Tuple
+
+_KAGGLE_CNN_VL_CONVOLUTIONS = [
+    dict(filters=128, kernel_size=(6, 6), strides=(2, 2), name="kaggle_cnn_1_c"),
+    dict(filters=128, kernel_size=(1, 7), strides=(1, 1), name="kaggle_cnn_2_c"),
+    dict(filters=256, kernel_size=(2, 9), strides=(1, 1), name="kaggle_cnn_3_c"),
+    dict(filters=512, kernel_size=(7, 1), strides=(2, 1), name="kaggle_cnn_4_c"),
+]
+
+
+def _kaggle_cnn_vl_head(x: tf.Tensor, embedding_dim: int) -> tf.Tensor:
+    x = tf.compat.v1.layers.Dense(512,
+                                  activation=tf.nn.relu,
+                                  name="kaggle_cnn_1d")(x)
+    print("x", x)
+
+    embedding = tf.compat.v1.layers.Dense(embedding_dim,
+                                          activation=None,
+                                          name="kaggle_cnn_2d")(x)
+    print("x", x)
+
+    return embedding
+
 
 def _kaggle_cnn_vl(x: tf.Tensor,
                    embedding_dim: int,
@@ -7,34 +30,14 @@ def _kaggle_cnn_vl(x: tf.Tensor,
     with tf.variable_scope('kaggle_cnn', reuse=tf.AUTO_REUSE):
         x = tf.expand_dims(x, -1)
         print("x", x)
-        x = tf.compat.v1.layers.Conv2D(filters=128,
-                                       kernel_size=(6, 6),
-                                       strides=(2, 2),
-                                       activation=tf.nn.relu,
-                                       name="kaggle_cnn_1_c")(x)
 
         # x = tf.compat.v1.layers.MaxPooling2D(pool_size=(1, 3), strides=(1, 3),
         # name="kaggle_cnn_1_m")(x)
         # x = tf.compat.v1.layers.MaxPooling2D(pool_size=(1, 3), strides=(1, 1), name="kaggle_cnn_1_m")(x)
-        print("x", x)
-        x = tf.compat.v1.layers.Conv2D(filters=128,
-                                       kernel_size=(1, 7),
-                                       activation=tf.nn.relu,
-                                       name="kaggle_cnn_2_c")(x)
-        print("x", x)
-        x = tf.compat.v1.layers.Conv2D(filters=256,
-                                       kernel_size=(2, 9),
-                                       # padding="valid",
-                                       activation=tf.nn.relu,
-                                       name="kaggle_cnn_3_c")(x)
-        print("x", x)
-        x = tf.compat.v1.layers.Conv2D(filters=512,
-                                       kernel_size=(7, 1),
-                                       strides=(2, 1),
-                                       activation=tf.nn.relu,
-                                       name="kaggle_cnn_4_c")(x)
+        for convolution in _KAGGLE_CNN_VL_CONVOLUTIONS:
+            x = tf.compat.v1.layers.Conv2D(**convolution, activation=tf.nn.relu)(x)
+            print("x", x)
 
-        print("x", x)
         x = tf.keras.layers.GlobalMaxPooling2D(name="kaggle_cnn_mp")(x)
         print("x", x)
 
@@ -42,19 +45,80 @@ def _kaggle_cnn_vl(x: tf.Tensor,
         #    x, training=mode == tf.estimator.ModeKeys.TRAIN,
         #    )
         #print("x", x)
-        x = tf.compat.v1.layers.Dense(512,
-                                      activation=tf.nn.relu,
-                                      name="kaggle_cnn_1d")(x)
-        print("x", x)
-
-        embedding = tf.compat.v1.layers.Dense(embedding_dim,
-                                              activation=None,
-                                              name="kaggle_cnn_2d")(x)
-        print("x", x)
+        embedding = _kaggle_cnn_vl_head(x, embedding_dim)
 
     return embedding
 
 
+def kaggle_cnn_time_stride() -> int:
+    """Number of feature frames per output frame of the convolutions."""
+    stride = 1
+    for convolution in _KAGGLE_CNN_VL_CONVOLUTIONS:
+        stride *= convolution["strides"][0]
+
+    return stride
+
+
+def kaggle_cnn_streaming_state_shapes(frames: int, coefficients: int) -> Dict[str, List[int]]:
+    """Shapes (without batch dimension) of the state carried between calls of kaggle_cnn_streaming.
+
+    'conv_i' holds the last input frames the i'th convolution needs to continue where it stopped and
+    'pooled' the frequency-pooled output of the last convolution over a window of 'frames' feature frames.
+    """
+    shapes = {}
+
+    time, frequency, channels = frames, coefficients, 1
+    for i, convolution in enumerate(_KAGGLE_CNN_VL_CONVOLUTIONS):
+        (time_kernel, frequency_kernel), (time_stride, frequency_stride) = convolution["kernel_size"], \
+                                                                           convolution["strides"]
+        if time_kernel > time_stride:
+            shapes[f"conv_{i}"] = [time_kernel - time_stride, frequency, channels]
+
+        time = (time - time_kernel) // time_stride + 1
+        frequency = (frequency - frequency_kernel) // frequency_stride + 1
+        channels = convolution["filters"]
+
+    shapes["pooled"] = [time, channels]
+
+    return shapes
+
+
+def kaggle_cnn_streaming(x: tf.Tensor,
+                         state: Dict[str, tf.Tensor],
+                         embedding_dim: int,
+                         mode: tf.estimator.ModeKeys) -> Tuple[tf.Tensor, Dict[str, tf.Tensor]]:
+    """Streaming version of kaggle_cnn sharing its weights.
+
+    Args:
+        x: The newest feature frames [batch_size, new_frames, coefficients], new_frames must be a multiple of
+           kaggle_cnn_time_stride()
+        state: The state returned by the previous call, see kaggle_cnn_streaming_state_shapes
+
+    Every convolution only runs on its new frames, the embedding is the one of the window
+    of the last pooled frames. Returns the embedding and the next state.
+    """
+    next_state = {}
+    with tf.variable_scope('kaggle_cnn', reuse=tf.AUTO_REUSE):
+        x = tf.expand_dims(x, -1)
+
+        for i, convolution in enumerate(_KAGGLE_CNN_VL_CONVOLUTIONS):
+            context = convolution["kernel_size"][0] - convolution["strides"][0]
+            if context > 0:
+                x = tf.concat([state[f"conv_{i}"], x], axis=1)
+                next_state[f"conv_{i}"] = x[:, -context:]
+
+            x = tf.compat.v1.layers.Conv2D(**convolution, activation=tf.nn.relu)(x)
+
+        # Same as GlobalMaxPooling2D, but pooled over frequency first so the window can be kept
+        window = int(state["pooled"].shape[1])
+        pooled = tf.concat([state["pooled"], tf.reduce_max(x, axis=2)], axis=1)[:, -window:]
+        next_state["pooled"] = pooled
+
+        embedding = _kaggle_cnn_vl_head(tf.reduce_max(pooled, axis=1), embedding_dim)
+
+    return embedding, next_state
+
+
 def _kaggle_cnn_v2(x: tf.Tensor,
                    embedding_dim: int,
                    mode: tf.estimator.ModeKeys,
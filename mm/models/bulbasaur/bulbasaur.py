@@ -4,11 +4,18 @@ import os
 # Some systems don't use the launching directory as root
 sys.path.append(os.getcwd())
 
+import json
+import zlib
+import functools
 import pathlib
+import itertools
+import numpy as np
 import tensorflow as tf
 import models.shared.audio as audio
 import argparse
 import models.bulbasaur.architechtures as arch
+import models.bulbasaur.quantization as quantization
+from shared.utterance_store import UtteranceStore
 from enum import Enum
 
 tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
@@ -17,6 +24,7 @@ tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
 class Mode(Enum):
     train_eval = "train_eval"
     export = "export"
+    export_streaming = "export_streaming"
 
 
 class Distance(Enum):
@@ -24,49 +32,200 @@ class Distance(Enum):
     EUCLIDEAN = "euclidean"
 
 
+class Loss(Enum):
+    TRIPLET = "triplet"
+    BATCH_HARD = "batch_hard"
+    SEMI_HARD = "semi_hard"
+
+
 def create_input_fn(mode: tf.estimator.ModeKeys,
                     input_prefix: str,
                     audio_length: int,
                     sample_rate: int,
                     parallel_reads: int = 5,
-                    batch_size: int = 32):
+                    batch_size: int = 32,
+                    utterance_store: pathlib.Path = None,
+                    words_per_batch: int = 16,
+                    triplets_per_word: int = 2,
+                    precomputed_features: bool = False,
+                    shuffle_buffer: int = 1000,
+                    shuffle_files: bool = True,
+                    parallel_calls: int = tf.data.experimental.AUTOTUNE,
+                    prefetch: int = tf.data.experimental.AUTOTUNE,
+                    cache: str = None,
+                    word_labels: bool = False):
+    """Creates the input_fn reading triplets from TFRecords matching 'input_prefix'.
+
+    With 'word_labels' the anchor, positive and negative words of the records are parsed too, the
+    batch_hard and semi_hard losses use them as labels.
+
+    'parallel_reads' files are read interleaved, when training in an order that is shuffled every epoch
+    unless 'shuffle_files' is False. Records are shuffled through 'shuffle_buffer' records, batched and
+    then parsed a whole batch at a time with 'parallel_calls' parallel batches. 'prefetch' batches are
+    prepared ahead of the model, AUTOTUNE for 'parallel_calls' and 'prefetch' lets tf.data pick them.
+
+    With 'cache' the records are read from the files once and then replayed, 'memory' keeps them in RAM,
+    anything else is the prefix of a cache file on local disk. A cache replays the file order of the
+    first epoch, records are still shuffled through 'shuffle_buffer'.
+
+    If 'utterance_store' is given triplets are instead mined on the fly from a store created by
+    pipelines/triplization.py. Each batch then mixes 'words_per_batch' anchor words with
+    'triplets_per_word' consecutive triplets per word.
+
+    If 'precomputed_features' the records are MFCC feature records created by pipelines/mfcc_features.py.
+    """
+    if utterance_store and precomputed_features:
+        raise ValueError("Precomputed features can not be mined from an utterance store")
+
     feature_description = {
         'anchor': tf.io.FixedLenFeature([], tf.string),
         'positive': tf.io.FixedLenFeature([], tf.string),
         'negative': tf.io.FixedLenFeature([], tf.string),
     }
 
-    def decode_example(x):
-        x = tf.io.parse_single_example(x, feature_description)
+    if word_labels:
+        for key in ["anchor_text", "positive_text", "negative_text"]:
+            feature_description[key] = tf.io.FixedLenFeature([], tf.string)
+
+    if precomputed_features:
+        feature_description['feature_fingerprint'] = tf.io.FixedLenFeature([], tf.int64)
+
+    def decode_examples(x):
+        x = tf.io.parse_example(x, feature_description)
+
+        for key in ["anchor", "positive", "negative"]:
+            x[key] = tf.reshape(tf.decode_raw(input_bytes=x[key], out_type=tf.int16), [-1, audio_length])
+
+        return x
+
+    def decode_feature_examples(x):
+        x = tf.io.parse_example(x, feature_description)
+
+        fingerprint_check = tf.debugging.assert_equal(
+            x["feature_fingerprint"],
+            tf.constant(feature_fingerprint(sample_rate, audio_length), dtype=tf.int64),
+            message="Precomputed features do not match the feature parameters of the model")
 
-        x["anchor"] = tf.reshape(tf.decode_raw(input_bytes=x["anchor"], out_type=tf.int16), [audio_length])
-        x["positive"] = tf.reshape(tf.decode_raw(input_bytes=x["positive"], out_type=tf.int16), [audio_length])
-        x["negative"] = tf.reshape(tf.decode_raw(input_bytes=x["negative"], out_type=tf.int16), [audio_length])
+        with tf.control_dependencies([fingerprint_check]):
+            for key in ["anchor", "positive", "negative"]:
+                x[key] = tf.reshape(tf.cast(tf.decode_raw(input_bytes=x[key], out_type=tf.float16), tf.float32),
+                                    [-1] + list(feature_shape(sample_rate, audio_length)))
 
         return x
 
+    def store_input_fn():
+        store = UtteranceStore(utterance_store)
+
+        # Evaluation uses fixed op seeds so every evaluation sees the same triplets
+        op_seeds = itertools.count(1) if mode == tf.estimator.ModeKeys.EVAL else itertools.repeat(None)
+
+        word_start = tf.constant(store.word_start[:-1], dtype=tf.int64)
+        counts = tf.constant(store.counts, dtype=tf.int64)
+        words = tf.constant([word.upper() for word in store.words])
+        num_words = len(store.words)
+
+        def uniform(maxval: tf.Tensor):
+            return tf.random.uniform([], maxval=maxval, dtype=tf.int64, seed=next(op_seeds))
+
+        def word_triplets(anchor: tf.Tensor):
+            def sample_triplet(_):
+                anchor_index = uniform(counts[anchor])
+
+                # Any other utterance of the anchor word
+                positive_index = uniform(counts[anchor] - 1)
+                positive_index += tf.cast(positive_index >= anchor_index, tf.int64)
+
+                # Any other word
+                negative = uniform(num_words - 1)
+                negative += tf.cast(negative >= anchor, tf.int64)
+                negative_index = uniform(counts[negative])
+
+                return {
+                    "anchor": word_start[anchor] + anchor_index,
+                    "positive": word_start[anchor] + positive_index,
+                    "negative": word_start[negative] + negative_index,
+                    "anchor_text": words[anchor],
+                    "positive_text": words[anchor],
+                    "negative_text": words[negative],
+                }
+
+            return tf.data.Dataset.range(triplets_per_word).map(sample_triplet)
+
+        def load_utterance(u: tf.Tensor):
+            utterance = tf.py_func(lambda u: np.array(store.utterance_at(u)), [u], tf.int16, stateful=False)
+            utterance.set_shape([None])
+            utterance = utterance[:audio_length]
+
+            # Same random bipadding as pipelines/preprocessing/random_bipadding.py
+            num_padding = audio_length - tf.shape(utterance)[0]
+            padding_split = tf.random.uniform([], maxval=num_padding + 1, dtype=tf.int32, seed=next(op_seeds))
+            padding = tf.cast(tf.random.normal([num_padding], stddev=10, seed=next(op_seeds)), tf.int16)
+
+            utterance = tf.concat([padding[:padding_split], utterance, padding[padding_split:]], axis=0)
+            return tf.reshape(utterance, [audio_length])
+
+        def load_triplet(x):
+            for key in ["anchor", "positive", "negative"]:
+                x[key] = load_utterance(x[key])
+
+            return x
+
+        anchor_words = np.flatnonzero(store.counts >= 2)
+
+        dataset = tf.data.Dataset.from_tensor_slices(anchor_words)
+        dataset = dataset.shuffle(buffer_size=len(anchor_words), seed=next(op_seeds))
+
+        # Evaluation mines 'triplets_per_word' triplets of every anchor word once and then ends
+        if mode == tf.estimator.ModeKeys.TRAIN:
+            dataset = dataset.repeat()
+
+        dataset = dataset.interleave(word_triplets,
+                                     cycle_length=words_per_batch,
+                                     block_length=1,
+                                     num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.map(load_triplet, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        dataset = dataset.batch(batch_size=batch_size)
+        dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+        return dataset
+
     def input_fn():
         entries = input_prefix.split("/")
         path = "/".join(entries[:-1])
         prefix = entries[-1]
 
-        files = [str(file) for file in pathlib.Path(path).glob(f"{prefix}")]
+        files = sorted(str(file) for file in pathlib.Path(path).glob(f"{prefix}"))
+        train = mode == tf.estimator.ModeKeys.TRAIN
 
-        dataset = tf.data.TFRecordDataset(filenames=files,
-                                          num_parallel_reads=parallel_reads)
-        dataset = dataset.map(decode_example)
+        dataset = tf.data.Dataset.from_tensor_slices(files)
+        if train and shuffle_files:
+            dataset = dataset.shuffle(buffer_size=len(files))
 
-        if mode == tf.estimator.ModeKeys.TRAIN:
-            # If we train we do data augmentation
-            dataset = dataset.shuffle(buffer_size=100)
+        dataset = dataset.interleave(tf.data.TFRecordDataset,
+                                     cycle_length=parallel_reads,
+                                     block_length=1,
+                                     num_parallel_calls=tf.data.experimental.AUTOTUNE)
 
-        dataset = dataset.batch(batch_size=batch_size)
+        if cache:
+            # Train and eval read different files, so each mode gets its own cache file
+            dataset = dataset.cache("" if cache == "memory" else f"{cache}.{mode}")
 
-        if mode == tf.estimator.ModeKeys.TRAIN:
+        if train:
+            # If we train we do data augmentation
+            dataset = dataset.shuffle(buffer_size=shuffle_buffer)
             dataset = dataset.repeat()
 
+        # Parsing whole batches is much cheaper than parsing every example on its own
+        dataset = dataset.batch(batch_size=batch_size)
+        dataset = dataset.map(decode_feature_examples if precomputed_features else decode_examples,
+                              num_parallel_calls=parallel_calls)
+        dataset = dataset.prefetch(prefetch)
+
         return dataset
 
+    if utterance_store:
+        return store_input_fn
+
     return input_fn
 
 
@@ -112,28 +271,150 @@ def euclidean_triplet_loss(anchor_embeddings: tf.Tensor,
     return tf.reduce_sum(triplet)
 
 
+def pairwise_distances(distance: Distance, embeddings: tf.Tensor):
+    """Distances between all rows of embeddings [N, D] -> [N, N]"""
+    if distance == Distance.COSINE:
+        embeddings = tf.linalg.l2_normalize(embeddings, axis=1)
+        return 1 - tf.matmul(embeddings, embeddings, transpose_b=True)
+
+    squared_norms = tf.reduce_sum(tf.square(embeddings), axis=1)
+    squared_distances = tf.expand_dims(squared_norms, 1) \
+                        - 2 * tf.matmul(embeddings, embeddings, transpose_b=True) \
+                        + tf.expand_dims(squared_norms, 0)
+
+    # Clip to avoid a nan gradient of sqrt at 0
+    return tf.sqrt(tf.maximum(squared_distances, 1e-12))
+
+
+def get_label_masks(labels: tf.Tensor):
+    """Masks [N, N] of same-label pairs (excluding the diagonal) and different-label pairs"""
+    same_label = tf.equal(tf.expand_dims(labels, 1), tf.expand_dims(labels, 0))
+    not_self = tf.logical_not(tf.cast(tf.eye(tf.shape(labels)[0]), tf.bool))
+
+    return tf.logical_and(same_label, not_self), tf.logical_not(same_label)
+
+
+def batch_hard_triplet_loss(distance: Distance,
+                            embeddings: tf.Tensor,
+                            labels: tf.Tensor,
+                            margin=1.0):
+    """Triplet loss of every embedding with its furthest positive and closest negative in the batch"""
+    d = pairwise_distances(distance, embeddings)
+    positive_mask, negative_mask = get_label_masks(labels)
+
+    hardest_positive = tf.reduce_max(tf.where(positive_mask, d, tf.zeros_like(d)), axis=1)
+    hardest_negative = tf.reduce_min(tf.where(negative_mask, d, tf.fill(tf.shape(d), tf.reduce_max(d))), axis=1)
+
+    # Same absolute form as cosine_triplet_loss
+    triplet = hardest_positive + 10 * tf.nn.relu(margin - hardest_negative)
+
+    valid = tf.logical_and(tf.reduce_any(positive_mask, axis=1), tf.reduce_any(negative_mask, axis=1))
+    return tf.reduce_sum(triplet * tf.cast(valid, tf.float32))
+
+
+def semi_hard_triplet_loss(distance: Distance,
+                           embeddings: tf.Tensor,
+                           labels: tf.Tensor,
+                           margin=1.0):
+    """Triplet loss of every positive pair with its closest negative that is further away than the positive.
+
+    If a pair has no such negative its furthest negative is used, as in tf.contrib.losses.metric_learning.
+    """
+    d = pairwise_distances(distance, embeddings)
+    positive_mask, negative_mask = get_label_masks(labels)
+
+    # The negatives of every anchor in ascending distance, non-negatives are sorted behind them
+    max_d = tf.reduce_max(d)
+    sorted_negatives = tf.sort(tf.where(negative_mask, d, tf.fill(tf.shape(d), max_d + 1)), axis=1)
+    num_negatives = tf.reduce_sum(tf.cast(negative_mask, tf.int32), axis=1, keepdims=True)
+
+    # [anchor, positive] index of the first negative further away than the positive
+    first_further = tf.searchsorted(sorted_negatives, d, side="right")
+    has_semi_hard = first_further < num_negatives
+
+    anchors = tf.tile(tf.expand_dims(tf.range(tf.shape(d)[0]), 1), [1, tf.shape(d)[1]])
+    semi_hard_negative = tf.gather_nd(sorted_negatives,
+                                      tf.stack([anchors, tf.minimum(first_further, tf.shape(d)[1] - 1)], axis=2))
+    furthest_negative = tf.reduce_max(tf.where(negative_mask, d, tf.zeros_like(d)), axis=1, keepdims=True)
+
+    negative = tf.where(has_semi_hard,
+                        semi_hard_negative,
+                        furthest_negative + tf.zeros_like(semi_hard_negative))
+
+    # Same absolute form as cosine_triplet_loss, averaged over the positives of each anchor
+    triplet = d + 10 * tf.nn.relu(margin - negative)
+
+    positive_mask = tf.cast(positive_mask, tf.float32)
+    return tf.reduce_sum(tf.reduce_sum(triplet * positive_mask, axis=1)
+                         / tf.maximum(tf.reduce_sum(positive_mask, axis=1), 1.0))
+
+
+def get_loss_op(loss: Loss,
+                distance: Distance,
+                anchor_embeddings: tf.Tensor,
+                positive_embeddings: tf.Tensor,
+                negative_embeddings: tf.Tensor,
+                labels: tf.Tensor,
+                margin: float):
+    if loss == Loss.TRIPLET:
+        return {
+            distance.COSINE: lambda *args: cosine_triplet_loss(*args),
+            distance.EUCLIDEAN: lambda *args: euclidean_triplet_loss(*args)
+        }[distance](anchor_embeddings, positive_embeddings, negative_embeddings, margin)
+
+    if labels is None:
+        raise ValueError(f"The {loss.value} loss needs the words of the triplets as labels")
+
+    # The mining losses treat the anchors, positives and negatives as one batch of labeled embeddings
+    embeddings = tf.concat([anchor_embeddings, positive_embeddings, negative_embeddings], axis=0)
+
+    return {
+        Loss.BATCH_HARD: lambda *args: batch_hard_triplet_loss(*args),
+        Loss.SEMI_HARD: lambda *args: semi_hard_triplet_loss(*args)
+    }[loss](distance, embeddings, labels, margin)
+
+
 def get_predict_ops(distance: Distance,
                     stored_embeddings: tf.Tensor,
                     signal_embeddings: tf.Tensor):
+    """Distances [N, K] from N signal embeddings to K stored embeddings and the closest stored embedding [N]"""
     d = {
         distance.COSINE: lambda *args: cosine_distance(*args),
         distance.EUCLIDEAN: lambda *args: euclidean_distance(*args)
-    }[distance](stored_embeddings, signal_embeddings)
+    }[distance](tf.expand_dims(stored_embeddings, 0), tf.expand_dims(signal_embeddings, 1))
 
-    predict_op = tf.argmin(d)
+    predict_op = tf.argmin(d, axis=1)
     return predict_op, d
 
 
-def get_metric_ops(distance: Distance,
+def get_keyword_ops(distances: tf.Tensor, embedding_labels: tf.Tensor, top_k: int):
+    """Keyword [N] with the most of the 'top_k' closest stored embeddings and their mean distance [N]
+
+    'embedding_labels' [K] is the keyword of each stored embedding, ties go to the smallest mean distance.
+    """
+    nearest, nearest_ids = tf.nn.top_k(-distances, k=tf.minimum(top_k, tf.shape(distances)[1]))
+    num_keywords = tf.reduce_max(embedding_labels) + 1
+    nearest_keywords = tf.one_hot(tf.gather(embedding_labels, nearest_ids), depth=num_keywords)
+
+    votes = tf.reduce_sum(nearest_keywords, axis=1)
+    mean_distance = tf.reduce_sum(nearest_keywords * tf.expand_dims(-nearest, 2), axis=1) / tf.maximum(votes, 1)
+
+    # Distances of normalized embeddings are at most 2, so a mean never outweighs a vote
+    keyword_op = tf.argmax(votes - mean_distance / 4, axis=1, output_type=tf.int32)
+    keyword_distance_op = tf.reduce_sum(mean_distance * tf.one_hot(keyword_op, depth=num_keywords), axis=1)
+
+    return keyword_op, keyword_distance_op
+
+
+def get_metric_ops(loss: Loss,
+                   distance: Distance,
                    anchor_embeddings: tf.Tensor,
                    positive_embeddings: tf.Tensor,
                    negative_embeddings: tf.Tensor,
+                   labels: tf.Tensor,
                    margin: float):
     metric_ops = {}
-    loss_op = {
-        distance.COSINE: lambda *args: cosine_triplet_loss(*args),
-        distance.EUCLIDEAN: lambda *args: euclidean_triplet_loss(*args)
-    }[distance](anchor_embeddings, positive_embeddings, negative_embeddings, margin)
+    loss_op = get_loss_op(loss, distance, anchor_embeddings, positive_embeddings, negative_embeddings, labels, margin)
 
     distance_op = {
         distance.COSINE: cosine_distance,
@@ -146,18 +427,17 @@ def get_metric_ops(distance: Distance,
     return loss_op, metric_ops
 
 
-def get_train_ops(distance: Distance,
+def get_train_ops(loss: Loss,
+                  distance: Distance,
                   anchor_embeddings: tf.Tensor,
                   positive_embeddings: tf.Tensor,
                   negative_embeddings: tf.Tensor,
+                  labels: tf.Tensor,
                   margin: float,
                   learning_rate: float,
                   save_summaries_every: int,
                   summary_output_dir: str):
-    loss_op = {
-        distance.COSINE: lambda *args: cosine_triplet_loss(*args),
-        distance.EUCLIDEAN: lambda *args: euclidean_triplet_loss(*args)
-    }[distance](anchor_embeddings, positive_embeddings, negative_embeddings, margin)
+    loss_op = get_loss_op(loss, distance, anchor_embeddings, positive_embeddings, negative_embeddings, labels, margin)
 
     #decay_learning_rate = tf.compat.v1.train.cosine_decay_restarts(
     #    learning_rate=learning_rate,
@@ -198,18 +478,38 @@ def get_train_ops(distance: Distance,
     return loss_op, train_op, train_logging_hooks
 
 
-def extract_audio_feature(signal: tf.Tensor, sample_rate: int):
+def feature_params(sample_rate: int) -> dict:
+    """Parameters of the MFCC features the model is trained on."""
     # TODO(jonasrsv): Try dropping first 2 MFCC features
     # To make invariant to loudness (gain)
-    return audio.mfcc_feature(signal=signal,
-                             coefficients=40,
-                             sample_rate=sample_rate,
-                             frame_length=1024,
-                             frame_step=512,
-                             fft_length=1024,
-                             num_mel_bins=120,
-                             lower_edge_hertz=1,
-                             upper_edge_hertz=sample_rate / 2)
+    return dict(coefficients=40,
+                sample_rate=sample_rate,
+                frame_length=1024,
+                frame_step=512,
+                fft_length=1024,
+                num_mel_bins=120,
+                lower_edge_hertz=1,
+                upper_edge_hertz=sample_rate / 2)
+
+
+def feature_shape(sample_rate: int, audio_length: int) -> [int]:
+    params = feature_params(sample_rate)
+    return [1 + (audio_length - params["frame_length"]) // params["frame_step"], params["coefficients"]]
+
+
+def feature_fingerprint(sample_rate: int, audio_length: int) -> int:
+    """Fingerprint stored with precomputed features to catch features computed with other parameters."""
+    params = {**feature_params(sample_rate), "audio_length": audio_length}
+    return zlib.crc32(json.dumps(params, sort_keys=True).encode("utf-8"))
+
+
+@functools.lru_cache()
+def feature_extractor(sample_rate: int) -> audio.FeatureExtractor:
+    return audio.FeatureExtractor(**feature_params(sample_rate))
+
+
+def extract_audio_feature(signal: tf.Tensor, sample_rate: int):
+    return feature_extractor(sample_rate).features(signal, ["mfcc"])["mfcc"]
     # return audio.mfcc_feature(signal=signal,
     #                          coefficients=20,
     #                          sample_rate=sample_rate,
@@ -231,80 +531,216 @@ def extract_audio_feature(signal: tf.Tensor, sample_rate: int):
                                          # upper_edge_hertz=sample_rate / 2)
 
 
-def get_embedding(audio_signal: tf.Tensor, sample_rate: int, embedding_dim: int, mode: tf.estimator.ModeKeys):
-    signal = extract_audio_feature(signal=audio.normalize_audio(audio_signal), sample_rate=sample_rate)
+def get_embedding(audio_signal: tf.Tensor,
+                  sample_rate: int,
+                  embedding_dim: int,
+                  mode: tf.estimator.ModeKeys,
+                  precomputed_features: bool = False):
+    if precomputed_features:
+        # The 'audio_signal' already is the output of extract_audio_feature
+        signal = audio_signal
+    else:
+        signal = extract_audio_feature(signal=audio.normalize_audio(audio_signal), sample_rate=sample_rate)
+
     return arch.kaggle_cnn(signal, embedding_dim=embedding_dim, mode=mode)
 
 
+def get_streaming_embedding(features,
+                            sample_rate: int,
+                            embedding_dim: int,
+                            mode: tf.estimator.ModeKeys):
+    """Embedding of the newest 'audio_hop' given the state of the previous hop.
+
+    The last samples of the previous hops are kept to continue the STFT, the convolutions keep their own
+    state, see arch.kaggle_cnn_streaming. Returns the embeddings and the 'next_state_*' ops by name.
+    """
+    extractor = feature_extractor(sample_rate)
+
+    signal = tf.concat([features["state_audio"], features["audio_hop"]], axis=0)
+    next_states = {
+        "next_state_audio": tf.identity(signal[-(extractor.frame_length - extractor.frame_step):],
+                                        name="next_state_audio")
+    }
+
+    new_features = extract_audio_feature(signal=audio.normalize_audio(tf.expand_dims(signal, 0)),
+                                         sample_rate=sample_rate)
+
+    state = {key[len("state_"):]: tf.expand_dims(value, 0)
+             for key, value in features.items() if key.startswith("state_") and key != "state_audio"}
+
+    embeddings, next_state = arch.kaggle_cnn_streaming(new_features, state, embedding_dim=embedding_dim, mode=mode)
+
+    for key, value in next_state.items():
+        next_states[f"next_state_{key}"] = tf.identity(tf.squeeze(value, 0), name=f"next_state_{key}")
+
+    return embeddings, next_states
+
+
+def streaming_inputs(clip_length: float, sample_rate: int, embedding_dim: int, hop: int) -> dict:
+    """Placeholders of the streaming export, the states should be zeros for the first hop."""
+    extractor = feature_extractor(sample_rate)
+
+    if hop % (extractor.frame_step * arch.kaggle_cnn_time_stride()):
+        raise ValueError(f"The hop must be a multiple of {extractor.frame_step * arch.kaggle_cnn_time_stride()} samples")
+
+    inputs = {
+        "audio_hop": tf.placeholder(shape=[hop], dtype=tf.int16, name="audio_hop"),
+        "embeddings": tf.placeholder(shape=[None, embedding_dim], dtype=tf.float32, name="embeddings"),
+        "state_audio": tf.placeholder(shape=[extractor.frame_length - extractor.frame_step],
+                                      dtype=tf.int16,
+                                      name="state_audio"),
+    }
+
+    frames, coefficients = feature_shape(sample_rate, int(clip_length * sample_rate))
+    for key, shape in arch.kaggle_cnn_streaming_state_shapes(frames, coefficients).items():
+        inputs[f"state_{key}"] = tf.placeholder(shape=shape, dtype=tf.float32, name=f"state_{key}")
+
+    return inputs
+
+
+def batch_only_signature(export_dir: str, signature: str = "batch"):
+    """Removes the 'audio' input from the batch signature of an export.
+
+    An estimator export gives every signature all receiver tensors, but the batch signature is run by
+    feeding 'batch_audio' only, so callers following the signature would have to feed a dummy 'audio'.
+    """
+    from tensorflow.core.protobuf import saved_model_pb2
+
+    path = os.path.join(export_dir, "saved_model.pb")
+    saved_model = saved_model_pb2.SavedModel()
+    with open(path, "rb") as saved_model_file:
+        saved_model.ParseFromString(saved_model_file.read())
+
+    for meta_graph in saved_model.meta_graphs:
+        if signature in meta_graph.signature_def:
+            del meta_graph.signature_def[signature].inputs["audio"]
+
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as saved_model_file:
+        saved_model_file.write(saved_model.SerializeToString())
+
+    os.replace(temporary, path)
+
+
+def get_triplet_embeddings(features,
+                           sample_rate: int,
+                           embedding_dim: int,
+                           mode: tf.estimator.ModeKeys,
+                           batched: bool = True,
+                           precomputed_features: bool = False):
+    """Embeddings of the anchors, positives and negatives.
+
+    If batched the three are concatenated into one batch of 3B and embedded in a single forward pass,
+    otherwise each is embedded by its own subgraph that shares weights with the others.
+    """
+    if batched:
+        audio_signal = tf.concat([features["anchor"], features["positive"], features["negative"]], axis=0)
+        embeddings = get_embedding(audio_signal,
+                                   sample_rate=sample_rate,
+                                   embedding_dim=embedding_dim,
+                                   mode=mode,
+                                   precomputed_features=precomputed_features)
+
+        return tf.split(embeddings, num_or_size_splits=3, axis=0)
+
+    return [get_embedding(features[key],
+                          sample_rate=sample_rate,
+                          embedding_dim=embedding_dim,
+                          mode=mode,
+                          precomputed_features=precomputed_features) for key in ["anchor", "positive", "negative"]]
+
+
+def get_labels(features):
+    """Word labels of the triplet batch, None if the input has no words"""
+    if "anchor_text" not in features:
+        return None
+
+    return tf.concat([features["anchor_text"], features["positive_text"], features["negative_text"]], axis=0)
+
+
 def make_model_fn(distance: Distance,
                   embedding_dim: int,
                   summary_output_dir: str,
+                  loss: Loss = Loss.TRIPLET,
                   margin: float = 1.0,
                   sample_rate: int = 16000,
                   save_summaries_every: int = 100,
-                  learning_rate: float = 0.001):
+                  learning_rate: float = 0.001,
+                  batched_forward_pass: bool = True,
+                  precomputed_features: bool = False,
+                  top_k: int = 10):
     def model_fn(features, labels, mode, config, params):
         print("features", features)
         loss_op, train_op, train_logging_hooks, eval_metric_ops, predict_op = None, None, None, None, None
+        export_outputs = None
         if mode == tf.estimator.ModeKeys.TRAIN:
-            anchor_embeddings = get_embedding(features["anchor"],
-                                              sample_rate=sample_rate,
-                                              embedding_dim=embedding_dim,
-                                              mode=mode)
-            positive_embeddings = get_embedding(features["positive"],
-                                                sample_rate=sample_rate,
-                                                embedding_dim=embedding_dim,
-                                                mode=mode)
-
-            negative_embeddings = get_embedding(features["negative"],
-                                                sample_rate=sample_rate,
-                                                embedding_dim=embedding_dim,
-                                                mode=mode)
+            anchor_embeddings, positive_embeddings, negative_embeddings = get_triplet_embeddings(
+                features,
+                sample_rate=sample_rate,
+                embedding_dim=embedding_dim,
+                mode=mode,
+                batched=batched_forward_pass,
+                precomputed_features=precomputed_features)
 
             loss_op, train_op, train_logging_hooks = get_train_ops(
+                loss=loss,
                 distance=distance,
                 anchor_embeddings=anchor_embeddings,
                 positive_embeddings=positive_embeddings,
                 negative_embeddings=negative_embeddings,
+                labels=get_labels(features),
                 margin=margin,
                 learning_rate=learning_rate,
                 save_summaries_every=save_summaries_every,
                 summary_output_dir=summary_output_dir)
         elif mode == tf.estimator.ModeKeys.EVAL:
-            anchor_embeddings = get_embedding(features["anchor"],
-                                              sample_rate=sample_rate,
-                                              embedding_dim=embedding_dim,
-                                              mode=mode)
-            positive_embeddings = get_embedding(features["positive"],
-                                                sample_rate=sample_rate,
-                                                embedding_dim=embedding_dim,
-                                                mode=mode)
-
-            negative_embeddings = get_embedding(features["negative"],
-                                                sample_rate=sample_rate,
-                                                embedding_dim=embedding_dim,
-                                                mode=mode)
-
-            loss_op, eval_metric_ops = get_metric_ops(distance=distance,
+            anchor_embeddings, positive_embeddings, negative_embeddings = get_triplet_embeddings(
+                features,
+                sample_rate=sample_rate,
+                embedding_dim=embedding_dim,
+                mode=mode,
+                batched=batched_forward_pass,
+                precomputed_features=precomputed_features)
+
+            loss_op, eval_metric_ops = get_metric_ops(loss=loss,
+                                                      distance=distance,
                                                       anchor_embeddings=anchor_embeddings,
                                                       positive_embeddings=positive_embeddings,
                                                       negative_embeddings=negative_embeddings,
+                                                      labels=get_labels(features),
                                                       margin=margin)
         elif mode == tf.estimator.ModeKeys.PREDICT:
-            embeddings = get_embedding(tf.expand_dims(features["audio"], 0),
-                                       sample_rate=sample_rate,
-                                       embedding_dim=embedding_dim,
-                                       mode=mode)
+            streaming = "audio_hop" in features
+            if streaming:
+                embeddings, next_states = get_streaming_embedding(features,
+                                                                  sample_rate=sample_rate,
+                                                                  embedding_dim=embedding_dim,
+                                                                  mode=mode)
+            else:
+                # 'batch_audio' defaults to the single 'audio' clip in exported models
+                audio_signal = features["batch_audio"] if "batch_audio" in features \
+                    else tf.expand_dims(features["audio"], 0)
+
+                embeddings = get_embedding(audio_signal,
+                                           sample_rate=sample_rate,
+                                           embedding_dim=embedding_dim,
+                                           mode=mode)
 
             embeddings = tf.linalg.l2_normalize(embeddings, axis=1)
 
-            predict_op, distance_op = get_predict_ops(
+            batch_predict_op, batch_distance_op = get_predict_ops(
                 distance=distance,
                 stored_embeddings=features["embeddings"],
                 signal_embeddings=embeddings,
             )
 
-            project_op = tf.squeeze(embeddings)
+            tf.identity(embeddings, name="batch_project")
+            tf.identity(batch_predict_op, name="batch_output")
+            tf.identity(batch_distance_op, name="batch_distances")
+
+            predict_op, distance_op = batch_predict_op[0], batch_distance_op[0]
+
+            project_op = embeddings[0]
 
             tf.identity(project_op, name="project")
             tf.identity(tf.shape(project_op), name="project_shape")
@@ -318,6 +754,48 @@ def make_model_fn(distance: Distance,
             min_distance_op = tf.reduce_min(distance_op)
             tf.identity(min_distance_op, name="min_distance")
             tf.identity(tf.shape(min_distance_op), name="min_distance_shape")
+
+            outputs = {
+                "project": project_op,
+                "output": predict_op,
+                "distances": distance_op,
+                "min_distance": min_distance_op
+            }
+
+            if streaming:
+                # Serving callers only see signature outputs, so the next states have to be among them
+                streaming_output = tf.estimator.export.PredictOutput({**outputs, **next_states})
+                export_outputs = {
+                    tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY: streaming_output,
+                    "streaming": streaming_output,
+                }
+            else:
+                export_outputs = {
+                    tf.saved_model.signature_constants.DEFAULT_SERVING_SIGNATURE_DEF_KEY:
+                        tf.estimator.export.PredictOutput(outputs),
+                    "batch": tf.estimator.export.PredictOutput({
+                        "project": embeddings,
+                        "output": batch_predict_op,
+                        "distances": batch_distance_op,
+                    })
+                }
+
+            if "embedding_labels" in features and not streaming:
+                batch_keyword_op, batch_keyword_distance_op = get_keyword_ops(batch_distance_op,
+                                                                              features["embedding_labels"],
+                                                                              top_k=top_k)
+
+                tf.identity(batch_keyword_op, name="batch_keyword")
+                tf.identity(batch_keyword_distance_op, name="batch_keyword_distance")
+
+                keyword_op, keyword_distance_op = batch_keyword_op[0], batch_keyword_distance_op[0]
+                tf.identity(keyword_op, name="keyword")
+                tf.identity(keyword_distance_op, name="keyword_distance")
+
+                export_outputs["keyword"] = tf.estimator.export.PredictOutput({
+                    "keyword": keyword_op,
+                    "keyword_distance": keyword_distance_op,
+                })
         else:
             raise Exception(f"Unknown ModeKey {mode}")
 
@@ -330,7 +808,8 @@ def make_model_fn(distance: Distance,
                                           loss=loss_op,
                                           train_op=train_op,
                                           training_hooks=train_logging_hooks,
-                                          eval_metric_ops=eval_metric_ops)
+                                          eval_metric_ops=eval_metric_ops,
+                                          export_outputs=export_outputs)
 
     return model_fn
 
@@ -340,7 +819,7 @@ def main():
     parser.add_argument("--mode",
                         required=True,
                         choices=[str(x).split(".")[1] for x in Mode],
-                        help="one of (train_eval or export)")
+                        help="one of (train_eval, export or export_streaming)")
     parser.add_argument(
         "--model_directory",
         required=True,
@@ -363,6 +842,10 @@ def main():
                         required=True,
                         choices=[x.value for x in Distance],
                         help="Distance to learn representation for")
+    parser.add_argument("--loss",
+                        default=Loss.TRIPLET.value,
+                        choices=[x.value for x in Loss],
+                        help="Triplet loss on the given triplets or with negatives mined from the whole batch")
     parser.add_argument("--margin",
                         required=True,
                         type=float,
@@ -391,6 +874,10 @@ def main():
                         default=10000,
                         type=int,
                         help="Evaluates on full dataset n steps")
+    parser.add_argument("--eval_steps",
+                        type=int,
+                        help="Number of evaluation batches, by default --eval_every batches of --eval_prefix "
+                             "or every anchor word of --eval_store once")
     parser.add_argument("--max_steps",
                         default=10000000,
                         type=int,
@@ -398,10 +885,68 @@ def main():
     parser.add_argument("--parallel_reads",
                         default=5,
                         type=int,
-                        help="Parallel reads of dataset")
+                        help="Number of files read interleaved")
+    parser.add_argument("--no_file_shuffle",
+                        action="store_true",
+                        help="Read the training files in the same order every epoch")
+    parser.add_argument("--shuffle_buffer",
+                        default=1000,
+                        type=int,
+                        help="Number of training records shuffled through")
+    parser.add_argument("--parallel_calls",
+                        default=tf.data.experimental.AUTOTUNE,
+                        type=int,
+                        help="Number of batches parsed in parallel, -1 lets tf.data tune it")
+    parser.add_argument("--prefetch",
+                        default=tf.data.experimental.AUTOTUNE,
+                        type=int,
+                        help="Number of batches prepared ahead of the model, -1 lets tf.data tune it")
+    parser.add_argument("--cache",
+                        type=str,
+                        help="Cache the train and eval records after the first epoch, 'memory' caches in RAM, "
+                             "anything else is the prefix of cache files on local disk")
+    parser.add_argument("--train_store",
+                        type=pathlib.Path,
+                        help="Utterance store to mine training triplets from instead of reading --train_prefix")
+    parser.add_argument("--eval_store",
+                        type=pathlib.Path,
+                        help="Utterance store to mine evaluation triplets from instead of reading --eval_prefix")
+    parser.add_argument("--precomputed_features",
+                        action="store_true",
+                        help="If the train and eval files are MFCC feature records from pipelines/mfcc_features.py")
+    parser.add_argument("--quantization",
+                        choices=[x.value for x in quantization.Quantization],
+                        help="Also write a quantized TFLite model of the export, calibrated on --eval_prefix")
+    parser.add_argument("--calibration_triplets",
+                        default=100,
+                        type=int,
+                        help="Number of triplets from --eval_prefix to calibrate the int8 quantization on")
+    parser.add_argument("--stream_hop",
+                        default=2048,
+                        type=int,
+                        help="Samples of new audio per call of a streaming export")
+    parser.add_argument("--keyword_export",
+                        action="store_true",
+                        help="Also export 'keyword' outputs that aggregate the --top_k closest stored embeddings "
+                             "per keyword, this needs the keyword of each stored embedding as 'embedding_labels'")
+    parser.add_argument("--top_k",
+                        default=10,
+                        type=int,
+                        help="Number of closest stored embeddings that vote on the keyword of a --keyword_export")
+    parser.add_argument("--words_per_batch",
+                        default=16,
+                        type=int,
+                        help="Number of anchor words in each batch mined from an utterance store")
 
     args = parser.parse_args()
 
+    # Evaluating on records keeps its --eval_every batches, a store ends after one pass over its anchor words
+    if args.eval_steps is None and not args.eval_store:
+        args.eval_steps = args.eval_every
+
+    if args.quantization and not args.eval_prefix:
+        parser.error("--quantization needs --eval_prefix to calibrate and evaluate the quantized model on")
+
     config = tf.estimator.RunConfig(
         model_dir=args.model_directory,
         save_summary_steps=args.save_summary_every,
@@ -414,10 +959,13 @@ def main():
             distance=Distance(args.distance),
             summary_output_dir=args.model_directory,
             embedding_dim=args.embedding_dim,
+            loss=Loss(args.loss),
             margin=args.margin,
             sample_rate=args.sample_rate,
             save_summaries_every=args.save_summary_every,
-            learning_rate=args.start_learning_rate),
+            learning_rate=args.start_learning_rate,
+            precomputed_features=args.precomputed_features,
+            top_k=args.top_k),
         model_dir=args.model_directory,
         config=config)
 
@@ -428,18 +976,38 @@ def main():
                                      audio_length=int(args.clip_length * args.sample_rate),
                                      sample_rate=args.sample_rate,
                                      parallel_reads=args.parallel_reads,
-                                     batch_size=args.batch_size),
+                                     batch_size=args.batch_size,
+                                     utterance_store=args.train_store,
+                                     words_per_batch=args.words_per_batch,
+                                     triplets_per_word=max(args.batch_size // args.words_per_batch, 1),
+                                     precomputed_features=args.precomputed_features,
+                                     word_labels=Loss(args.loss) != Loss.TRIPLET,
+                                     shuffle_buffer=args.shuffle_buffer,
+                                     shuffle_files=not args.no_file_shuffle,
+                                     parallel_calls=args.parallel_calls,
+                                     prefetch=args.prefetch,
+                                     cache=args.cache),
             max_steps=args.max_steps,
         )
 
         eval_spec = tf.estimator.EvalSpec(
-            steps=args.eval_every,
+            steps=args.eval_steps,
             input_fn=create_input_fn(mode=tf.estimator.ModeKeys.EVAL,
-                                     input_prefix=args.train_prefix,
+                                     input_prefix=args.eval_prefix,
                                      audio_length=int(args.clip_length * args.sample_rate),
                                      sample_rate=args.sample_rate,
                                      parallel_reads=args.parallel_reads,
-                                     batch_size=args.batch_size),
+                                     batch_size=args.batch_size,
+                                     utterance_store=args.eval_store,
+                                     words_per_batch=args.words_per_batch,
+                                     triplets_per_word=max(args.batch_size // args.words_per_batch, 1),
+                                     precomputed_features=args.precomputed_features,
+                                     word_labels=Loss(args.loss) != Loss.TRIPLET,
+                                     shuffle_buffer=args.shuffle_buffer,
+                                     shuffle_files=not args.no_file_shuffle,
+                                     parallel_calls=args.parallel_calls,
+                                     prefetch=args.prefetch,
+                                     cache=args.cache),
             throttle_secs=5,
         )
 
@@ -453,12 +1021,48 @@ def main():
                 "audio": tf.placeholder(shape=[audio_length], dtype=tf.int16, name="audio"),
                 "embeddings": tf.placeholder(shape=[None, args.embedding_dim], dtype=tf.float32, name="embeddings"),
             }
+
+            # Feed 'batch_audio' instead of 'audio' to embed many clips in one run
+            inputs["batch_audio"] = tf.compat.v1.placeholder_with_default(tf.expand_dims(inputs["audio"], 0),
+                                                                          shape=[None, audio_length],
+                                                                          name="batch_audio")
+
+            if args.keyword_export:
+                # The keyword of each row of 'embeddings'
+                inputs["embedding_labels"] = tf.placeholder(shape=[None], dtype=tf.int32, name="embedding_labels")
+
             return tf.estimator.export.ServingInputReceiver(
                 features=inputs, receiver_tensors=inputs)
 
-        estimator.export_saved_model(
+        export_dir = estimator.export_saved_model(
             export_dir_base=args.model_directory,
             serving_input_receiver_fn=serving_input_receiver_fn)
+
+        batch_only_signature(export_dir.decode("utf-8"))
+
+        if args.quantization:
+            report = quantization.quantize_export(export_dir=export_dir.decode("utf-8"),
+                                                  quantization=quantization.Quantization(args.quantization),
+                                                  eval_prefix=args.eval_prefix,
+                                                  distance=args.distance,
+                                                  embedding_dim=args.embedding_dim,
+                                                  calibration_triplets=args.calibration_triplets)
+
+            tf.compat.v1.logging.info(f"Quantized export: {report}")
+
+    elif args.mode == Mode.export_streaming.value:
+
+        def streaming_serving_input_receiver_fn():
+            inputs = streaming_inputs(clip_length=args.clip_length,
+                                      sample_rate=args.sample_rate,
+                                      embedding_dim=args.embedding_dim,
+                                      hop=args.stream_hop)
+            return tf.estimator.export.ServingInputReceiver(
+                features=inputs, receiver_tensors=inputs)
+
+        estimator.export_saved_model(
+            export_dir_base=args.model_directory,
+            serving_input_receiver_fn=streaming_serving_input_receiver_fn)
     else:
         raise NotImplementedError(f"Unknown mode {args.mode}")
 
@@ -0,0 +1,216 @@
+"""Embeds enrollment clips with an exported bulbasaur model.
+
+As a script it keeps a store of the embeddings of a words directory (word/*.wav, as written by
+pipelines/mfa_alignments_to_words_dataset.py) up to date, only clips that are not in the store yet are embedded.
+"""
+import sys
+import os
+
+# Some systems don't use the launching directory as root
+sys.path.append(os.getcwd())
+
+import json
+import hashlib
+import pathlib
+import argparse
+import itertools
+import numpy as np
+import tensorflow as tf
+import models.shared.embedding_index as embedding_index
+import shared.audio_io as audio_io
+from typing import Iterable, List
+
+STORE_FILE = "embeddings.npz"
+
+
+def fit_length(clip: np.ndarray, audio_length: int) -> np.ndarray:
+    """Cuts or zero pads a clip to the input length of the model"""
+    clip = np.asarray(clip, dtype=np.int16)[:audio_length]
+    return np.pad(clip, [0, audio_length - len(clip)])
+
+
+def embed_clips(export_dir: str, clips: Iterable[np.ndarray], batch_size: int = 64) -> np.ndarray:
+    """Embeddings [N, D] of the clips, 'batch_size' clips per run of the model
+
+    'clips' is consumed one batch at a time, so it can be a generator that decodes files lazily.
+    """
+    with tf.Graph().as_default() as graph, tf.compat.v1.Session() as session:
+        tf.compat.v1.saved_model.loader.load(session, [tf.saved_model.tag_constants.SERVING], export_dir)
+
+        audio_length = graph.get_tensor_by_name("audio:0").shape.as_list()[0]
+        embedding_dim = graph.get_tensor_by_name("embeddings:0").shape.as_list()[1]
+
+        clips = iter(clips)
+
+        embeddings = [np.zeros([0, embedding_dim], dtype=np.float32)]
+        for batch in iter(lambda: list(itertools.islice(clips, batch_size)), []):
+            batch = np.stack([fit_length(clip, audio_length) for clip in batch])
+            embeddings.append(session.run("batch_project:0", feed_dict={"batch_audio:0": batch}))
+
+    return np.concatenate(embeddings)
+
+
+def build_index(export_dir: str,
+                clips: List[np.ndarray],
+                labels: List[int],
+                distance: str = "cosine",
+                subspaces: int = 0,
+                batch_size: int = 64) -> embedding_index.FlatIndex:
+    """Index of the enrollment clips of each keyword, product quantized if 'subspaces' is set"""
+    embeddings = embed_clips(export_dir, clips, batch_size)
+
+    if subspaces:
+        return embedding_index.ProductQuantizedIndex(embeddings, labels, distance=distance, subspaces=subspaces)
+
+    return embedding_index.FlatIndex(embeddings, labels, distance=distance)
+
+
+def export_fingerprint(export_dir: str) -> str:
+    """Hash of the graph and variables of an export, stored embeddings are only valid for the same fingerprint"""
+    export_dir = pathlib.Path(export_dir)
+    files = [export_dir / "saved_model.pb"] + sorted((export_dir / "variables").glob("*"))
+
+    digest = hashlib.sha1()
+    for file in files:
+        digest.update(file.name.encode("utf-8"))
+        with open(str(file), "rb") as content:
+            for chunk in iter(lambda: content.read(2 ** 20), b""):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class EmbeddingStore:
+    """float16 embeddings of enrollment clips together with the keyword and file of each clip.
+
+    'sample_rate' is the rate the clips were resampled to before embedding, the rate the export was trained on.
+    """
+
+    def __init__(self,
+                 fingerprint: str,
+                 sample_rate: int,
+                 embeddings: np.ndarray,
+                 words: List[str],
+                 files: List[str]):
+        self.fingerprint = fingerprint
+        self.sample_rate = sample_rate
+        self.embeddings = embeddings.astype(np.float16)
+        self.words = list(words)
+        self.files = list(files)
+
+    @property
+    def keywords(self) -> List[str]:
+        return sorted(set(self.words))
+
+    @property
+    def labels(self) -> np.ndarray:
+        """Keyword id of each embedding, the index into 'keywords'"""
+        keyword_ids = {keyword: i for i, keyword in enumerate(self.keywords)}
+        return np.array([keyword_ids[word] for word in self.words], dtype=np.int32)
+
+    def index(self, distance: str = "cosine", subspaces: int = 0) -> embedding_index.FlatIndex:
+        embeddings = self.embeddings.astype(np.float32)
+        if subspaces:
+            return embedding_index.ProductQuantizedIndex(embeddings, self.labels, distance=distance, subspaces=subspaces)
+
+        return embedding_index.FlatIndex(embeddings, self.labels, distance=distance)
+
+    def save(self, path: pathlib.Path):
+        # Written next to the store and renamed, so an interrupted update keeps the old store
+        temporary = path.parent / f".{path.name}.tmp"
+        with open(str(temporary), "wb") as store_file:
+            np.savez(store_file,
+                     embeddings=self.embeddings,
+                     labels=self.labels,
+                     keywords=np.array(self.keywords),
+                     words=np.array(self.words),
+                     files=np.array(self.files),
+                     meta=json.dumps({"fingerprint": self.fingerprint,
+                                      "sample_rate": self.sample_rate,
+                                      "embedding_dim": int(self.embeddings.shape[1])}))
+
+        os.replace(str(temporary), str(path))
+
+    @staticmethod
+    def load(path: pathlib.Path) -> "EmbeddingStore":
+        store = np.load(str(path))
+        meta = json.loads(str(store["meta"]))
+
+        return EmbeddingStore(fingerprint=meta["fingerprint"],
+                              sample_rate=meta["sample_rate"],
+                              embeddings=store["embeddings"],
+                              words=store["words"].tolist(),
+                              files=store["files"].tolist())
+
+
+def update_store(export_dir: str,
+                 words_directory: pathlib.Path,
+                 sink: pathlib.Path,
+                 sample_rate: int,
+                 batch_size: int) -> EmbeddingStore:
+    """Embeds the clips of 'words_directory' that are not in 'sink' yet, resampled to 'sample_rate'"""
+    fingerprint = export_fingerprint(export_dir)
+
+    files = [file for word in sorted(words_directory.glob("*")) for file in sorted(word.glob("*.wav"))]
+    names = [str(file.relative_to(words_directory)) for file in files]
+
+    if not files:
+        raise ValueError(f"{words_directory} has no clips to embed, expected word/*.wav")
+
+    store = None
+    if sink.is_file():
+        store = EmbeddingStore.load(sink)
+
+        if store.fingerprint != fingerprint:
+            tf.compat.v1.logging.info(f"{sink} was embedded by another export, embedding all clips")
+            store = None
+        elif store.sample_rate != sample_rate:
+            tf.compat.v1.logging.info(f"{sink} was embedded at another sample rate, embedding all clips")
+            store = None
+
+    embedded = {}
+    if store:
+        embedded = {file: (store.embeddings[i], store.words[i]) for i, file in enumerate(store.files)}
+
+    new_files = [file for file, name in zip(files, names) if name not in embedded]
+    tf.compat.v1.logging.info(f"Embedding {len(new_files)} new of {len(files)} clips")
+
+    new_embeddings = embed_clips(export_dir,
+                                 (audio_io.read(file, sample_rate) for file in new_files),
+                                 batch_size=batch_size)
+
+    for file, embedding in zip(new_files, new_embeddings):
+        embedded[str(file.relative_to(words_directory))] = (embedding, file.parent.name)
+
+    # Clips that were removed from the words directory are dropped from the store
+    embeddings = np.array([embedded[name][0] for name in names], dtype=np.float16).reshape([len(names), -1])
+    store = EmbeddingStore(fingerprint=fingerprint,
+                           sample_rate=sample_rate,
+                           embeddings=embeddings,
+                           words=[embedded[name][1] for name in names],
+                           files=names)
+    store.save(sink)
+
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--export_dir", type=str, required=True, help="Directory of an exported model")
+    parser.add_argument("--words_directory", type=pathlib.Path, required=True,
+                        help="Directory with a directory of wav files per keyword")
+    parser.add_argument("--sink", type=pathlib.Path, required=True,
+                        help="Embedding store to create or update")
+    parser.add_argument("--sample_rate", type=int, required=True,
+                        help="Sample rate the export was trained on, clips are resampled to it")
+    parser.add_argument("--batch_size", type=int, default=64, help="Clips to embed per run of the model")
+
+    args = parser.parse_args()
+
+    tf.compat.v1.logging.set_verbosity(tf.compat.v1.logging.INFO)
+
+    update_store(export_dir=args.export_dir,
+                 words_directory=args.words_directory,
+                 sink=args.sink,
+                 sample_rate=args.sample_rate,
+                 batch_size=args.batch_size)
@@ -0,0 +1,156 @@
+"""Post-training quantization of an exported bulbasaur model into a TFLite flatbuffer."""
+import json
+import pathlib
+import numpy as np
+import tensorflow as tf
+import shared.tfexample_dma_utils as tfexample_dma_utils
+from enum import Enum
+from typing import List, Tuple
+
+# Op names of the exported model, the TFLite model keeps them
+INPUT_ARRAYS = ["audio", "embeddings"]
+OUTPUT_ARRAYS = ["project", "distances", "min_distance", "output"]
+
+
+class Quantization(Enum):
+    WEIGHTS = "weights"
+    INT8 = "int8"
+
+
+def read_triplets(prefix: str, max_triplets: int) -> List[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """The (anchor, positive, negative) audio of the first 'max_triplets' triplets matching 'prefix'."""
+    entries = prefix.split("/")
+    path = "/".join(entries[:-1])
+    glob_prefix = entries[-1]
+
+    triplets = []
+    for file in sorted(pathlib.Path(path).glob(glob_prefix)):
+        for serialized_example in tf.compat.v1.io.tf_record_iterator(str(file)):
+            example = tf.train.Example()
+            example.ParseFromString(serialized_example)
+
+            triplets.append((tfexample_dma_utils.get_anchor_audio(example),
+                             tfexample_dma_utils.get_positive_audio(example),
+                             tfexample_dma_utils.get_negative_audio(example)))
+
+            if len(triplets) >= max_triplets:
+                return triplets
+
+    return triplets
+
+
+def convert(export_dir: str,
+            quantization: Quantization,
+            calibration_clips: List[np.ndarray],
+            calibration_embeddings: np.ndarray) -> bytes:
+    """The TFLite flatbuffer of an export, its 'embeddings' input has a batch of 1, see resize_embeddings."""
+    converter = tf.lite.TFLiteConverter.from_saved_model(export_dir,
+                                                         input_arrays=INPUT_ARRAYS,
+                                                         output_arrays=OUTPUT_ARRAYS)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+
+    # The STFT has no TFLite builtin
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+
+    if quantization == Quantization.INT8:
+        def representative_dataset():
+            # The distances are calibrated against real projections, a single one as the input is pinned to [1, D]
+            for i, clip in enumerate(calibration_clips):
+                yield [clip, calibration_embeddings[i % len(calibration_embeddings)][np.newaxis]]
+
+        converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+
+    return converter.convert()
+
+
+def float_projections(export_dir: str, clips: List[np.ndarray]) -> np.ndarray:
+    with tf.Graph().as_default(), tf.compat.v1.Session() as session:
+        tf.compat.v1.saved_model.loader.load(session, [tf.saved_model.tag_constants.SERVING], export_dir)
+
+        return np.array([session.run("project:0", feed_dict={"audio:0": clip}) for clip in clips])
+
+
+def resize_embeddings(interpreter: tf.lite.Interpreter, embeddings: np.ndarray):
+    """Sets the stored embeddings [K, D] of a TFLite model.
+
+    The converter pins the [None, D] 'embeddings' input to a single embedding, every consumer has to resize it
+    to the number of stored embeddings, otherwise 'distances' and 'output' only compare with one embedding.
+    """
+    index = next(detail["index"] for detail in interpreter.get_input_details() if detail["name"] == "embeddings")
+
+    interpreter.resize_tensor_input(index, list(embeddings.shape))
+    interpreter.allocate_tensors()
+    interpreter.set_tensor(index, embeddings.astype(np.float32))
+
+
+def tflite_projections(tflite_model: bytes, clips: List[np.ndarray], embeddings: np.ndarray) -> np.ndarray:
+    interpreter = tf.lite.Interpreter(model_content=tflite_model)
+    resize_embeddings(interpreter, embeddings)
+
+    inputs = {detail["name"]: detail["index"] for detail in interpreter.get_input_details()}
+    outputs = {detail["name"]: detail["index"] for detail in interpreter.get_output_details()}
+
+    projections = []
+    for clip in clips:
+        interpreter.set_tensor(inputs["audio"], clip)
+        interpreter.invoke()
+
+        projections.append(np.array(interpreter.get_tensor(outputs["project"])))
+
+    return np.array(projections)
+
+
+def triplet_accuracy(distance: str, projections: np.ndarray) -> float:
+    """The 'correct' metric of bulbasaur on projections [triplets, 3, D] of (anchor, positive, negative)."""
+    anchor, positive, negative = projections[:, 0], projections[:, 1], projections[:, 2]
+
+    if distance == "cosine":
+        d = lambda a, b: 1 - np.sum(a * b, axis=-1)
+    else:
+        d = lambda a, b: np.sqrt(np.sum(np.square(a - b), axis=-1))
+
+    return float(np.mean(d(anchor, positive) < d(anchor, negative)))
+
+
+def quantize_export(export_dir: str,
+                    quantization: Quantization,
+                    eval_prefix: str,
+                    distance: str,
+                    embedding_dim: int,
+                    calibration_triplets: int = 100,
+                    evaluation_triplets: int = 1000) -> dict:
+    """Writes model.tflite into 'export_dir' and a report comparing its accuracy to the float model."""
+    triplets = read_triplets(eval_prefix, calibration_triplets + evaluation_triplets)
+    calibration, evaluation = triplets[:calibration_triplets], triplets[calibration_triplets:]
+
+    calibration_clips = [clip for triplet in calibration for clip in triplet]
+    evaluation_clips = [clip for triplet in evaluation for clip in triplet]
+
+    # Projections of the calibration anchors act as the stored embeddings
+    calibration_embeddings = float_projections(export_dir, [anchor for anchor, _, _ in calibration or evaluation])
+
+    tflite_model = convert(export_dir, quantization, calibration_clips, calibration_embeddings)
+
+    tflite_path = pathlib.Path(export_dir) / "model.tflite"
+    with open(str(tflite_path), "wb") as tflite_file:
+        tflite_file.write(tflite_model)
+
+    float_correct = triplet_accuracy(
+        distance, float_projections(export_dir, evaluation_clips).reshape([-1, 3, embedding_dim]))
+    quantized_correct = triplet_accuracy(
+        distance,
+        tflite_projections(tflite_model, evaluation_clips, calibration_embeddings).reshape([-1, 3, embedding_dim]))
+
+    report = {
+        "quantization": quantization.value,
+        "tflite_bytes": len(tflite_model),
+        "evaluation_triplets": len(evaluation),
+        "float_correct": float_correct,
+        "quantized_correct": quantized_correct,
+        "correct_delta": quantized_correct - float_correct
+    }
+
+    with open(str(pathlib.Path(export_dir) / "quantization.json"), "w") as report_file:
+        json.dump(report, report_file, indent=2)
+
+    return report
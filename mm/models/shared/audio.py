@@ -1,5 +1,9 @@
 """This module implements extraction of logmel features from a raw audio signal"""
+import numpy as np
 import tensorflow as tf
+from typing import Dict, Iterable
+
+FEATURES = ["spectrogram", "power", "mel", "log_mel", "mfcc"]
 
 
 def normalize_audio(signal: tf.Tensor):
@@ -10,6 +14,137 @@ def normalize_mfcc(mfcc: tf.Tensor) -> tf.Tensor:
     return mfcc
 
 
+def hertz_to_mel(frequencies_hertz: np.ndarray) -> np.ndarray:
+    return 1127.0 * np.log(1.0 + frequencies_hertz / 700.0)
+
+
+def linear_to_mel_weight_matrix(num_mel_bins: int,
+                                num_spectrogram_bins: int,
+                                sample_rate: int,
+                                lower_edge_hertz: float,
+                                upper_edge_hertz: float) -> np.ndarray:
+    """NumPy version of tf.signal.linear_to_mel_weight_matrix"""
+    # The DC bin is excluded, it gets zero weight
+    linear_frequencies = np.linspace(0.0, sample_rate / 2, num_spectrogram_bins)[1:]
+    spectrogram_bins_mel = np.expand_dims(hertz_to_mel(linear_frequencies), 1)
+
+    band_edges_mel = np.linspace(hertz_to_mel(np.array(lower_edge_hertz, dtype=np.float64)),
+                                 hertz_to_mel(np.array(upper_edge_hertz, dtype=np.float64)),
+                                 num_mel_bins + 2)
+    lower_edge_mel = band_edges_mel[:-2]
+    center_mel = band_edges_mel[1:-1]
+    upper_edge_mel = band_edges_mel[2:]
+
+    lower_slopes = (spectrogram_bins_mel - lower_edge_mel) / (center_mel - lower_edge_mel)
+    upper_slopes = (upper_edge_mel - spectrogram_bins_mel) / (upper_edge_mel - center_mel)
+
+    mel_weights_matrix = np.maximum(0.0, np.minimum(lower_slopes, upper_slopes))
+
+    return np.pad(mel_weights_matrix, [[1, 0], [0, 0]]).astype(np.float32)
+
+
+def dct_matrix(num_mel_bins: int, coefficients: int) -> np.ndarray:
+    """The DCT-II used by tf.signal.mfccs_from_log_mel_spectrograms as a [num_mel_bins, coefficients] matrix"""
+    n = np.arange(num_mel_bins)
+    k = np.arange(coefficients)
+    dct = 2.0 * np.cos(np.pi * np.outer(2 * n + 1, k) / (2.0 * num_mel_bins))
+
+    return (dct / np.sqrt(2.0 * num_mel_bins)).astype(np.float32)
+
+
+class FeatureExtractor:
+    """Computes spectrograms, mel spectrograms and MFCC's from a shared STFT.
+
+    The mel weight matrix is computed once and embedded as a constant. Every feature
+    has a NumPy twin, see 'numpy_features', for use outside of a TensorFlow graph.
+
+    Args:
+        sample_rate: Sample rate of audio signal
+        frame_length: Length of short time FFT frame
+        frame_step: Length of frame step
+        fft_length: Length of FFT time
+        lower_edge_hertz: Lower-bound of frequencies to include in signal
+        upper_edge_hertz: Upper-bound of frequencies to include in signal
+        num_mel_bins: Bands in the mel spectrum
+        coefficients: The number of MFCC coefficients to extract
+    """
+
+    def __init__(self,
+                 sample_rate: int,
+                 frame_length=1024,
+                 frame_step=256,
+                 fft_length=1024,
+                 lower_edge_hertz=80.0,
+                 upper_edge_hertz=7600.0,
+                 num_mel_bins=40,
+                 coefficients=40):
+        self.sample_rate = sample_rate
+        self.frame_length = frame_length
+        self.frame_step = frame_step
+        self.fft_length = fft_length
+        self.num_mel_bins = num_mel_bins
+        self.coefficients = coefficients
+
+        self.linear_to_mel_weight_matrix = linear_to_mel_weight_matrix(num_mel_bins=num_mel_bins,
+                                                                       num_spectrogram_bins=fft_length // 2 + 1,
+                                                                       sample_rate=sample_rate,
+                                                                       lower_edge_hertz=lower_edge_hertz,
+                                                                       upper_edge_hertz=upper_edge_hertz)
+
+        self.window = (0.5 - 0.5 * np.cos(2 * np.pi * np.arange(frame_length) / frame_length)).astype(np.float32)
+
+    def features(self, signal: tf.Tensor, names: Iterable[str] = FEATURES) -> Dict[str, tf.Tensor]:
+        """Computes the named features from a batch float tensor [batch_size, clip_length] with values in [-1, 1]"""
+        names = list(names)
+        features = {}
+
+        # Short time fourier transform across the signal
+        stfts = tf.signal.stft(signal,
+                               frame_length=self.frame_length,
+                               frame_step=self.frame_step,
+                               fft_length=self.fft_length)
+
+        features["spectrogram"] = tf.abs(stfts)
+
+        if "power" in names:
+            features["power"] = tf.square(features["spectrogram"])
+
+        if {"mel", "log_mel", "mfcc"} & set(names):
+            features["mel"] = tf.tensordot(features["spectrogram"], tf.constant(self.linear_to_mel_weight_matrix), 1)
+            features["mel"].set_shape(features["spectrogram"].shape[:-1].concatenate([self.num_mel_bins]))
+
+            # Log-mel trick
+            features["log_mel"] = tf.math.log(features["mel"] + 1e-6)
+
+            features["mfcc"] = normalize_mfcc(tf.signal.mfccs_from_log_mel_spectrograms(
+                features["log_mel"])[..., :self.coefficients])
+
+        return {name: features[name] for name in names}
+
+    def numpy_features(self, signal: np.ndarray, names: Iterable[str] = FEATURES) -> Dict[str, np.ndarray]:
+        """NumPy twin of 'features'"""
+        names = list(names)
+        features = {}
+
+        num_frames = 1 + (signal.shape[-1] - self.frame_length) // self.frame_step
+        frame_starts = np.arange(num_frames) * self.frame_step
+        frames = signal[..., frame_starts[:, None] + np.arange(self.frame_length)]
+
+        stfts = np.fft.rfft(frames * self.window, n=self.fft_length)
+
+        features["spectrogram"] = np.abs(stfts).astype(np.float32)
+
+        if "power" in names:
+            features["power"] = np.square(features["spectrogram"])
+
+        if {"mel", "log_mel", "mfcc"} & set(names):
+            features["mel"] = features["spectrogram"] @ self.linear_to_mel_weight_matrix
+            features["log_mel"] = np.log(features["mel"] + 1e-6)
+            features["mfcc"] = features["log_mel"] @ dct_matrix(self.num_mel_bins, self.coefficients)
+
+        return {name: features[name] for name in names}
+
+
 def mfcc_feature(signal: tf.Tensor, coefficients: int,
                  frame_length=1024, frame_step=256,
                  fft_length=1024,
@@ -30,34 +165,16 @@ def mfcc_feature(signal: tf.Tensor, coefficients: int,
         upper_edge_hertz: Upper-bound of frequencies to include in signal
         num_mel_bins: Bands in the mel spectrum
     """
+    extractor = FeatureExtractor(sample_rate=sample_rate,
+                                 frame_length=frame_length,
+                                 frame_step=frame_step,
+                                 fft_length=fft_length,
+                                 lower_edge_hertz=lower_edge_hertz,
+                                 upper_edge_hertz=upper_edge_hertz,
+                                 num_mel_bins=num_mel_bins,
+                                 coefficients=coefficients)
 
-    # Short time fourier transform across the signal
-    stfts = tf.signal.stft(signal,
-                           frame_length=frame_length,
-                           frame_step=frame_step,
-                           fft_length=fft_length)
-
-    # Turn into spectrograms
-    spectrograms = tf.abs(stfts)
-
-    # Calculate mel features
-    num_spectrogram_bins = stfts.shape[-1].value
-    linear_to_mel_weight_matrix = tf.signal.linear_to_mel_weight_matrix(
-        num_mel_bins=num_mel_bins, num_spectrogram_bins=num_spectrogram_bins,
-        sample_rate=sample_rate,
-        lower_edge_hertz=lower_edge_hertz,
-        upper_edge_hertz=upper_edge_hertz)
-    mel_spectrograms = tf.tensordot(
-        spectrograms, linear_to_mel_weight_matrix, 1)
-    mel_spectrograms.set_shape(spectrograms.shape[:-1].concatenate(
-        linear_to_mel_weight_matrix.shape[-1:]))
-
-    # Log-mel trick
-    log_mel_spectrograms = tf.math.log(mel_spectrograms + 1e-6)
-
-    # Extract MFCC's
-    return normalize_mfcc(tf.signal.mfccs_from_log_mel_spectrograms(
-        log_mel_spectrograms)[..., :coefficients])
+    return extractor.features(signal, ["mfcc"])["mfcc"]
 
 
 def mel_spectrogram_feature(signal: tf.Tensor,
@@ -81,26 +198,12 @@ def mel_spectrogram_feature(signal: tf.Tensor,
         upper_edge_hertz: Upper-bound of frequencies to include in signal
         num_mel_bins: Bands in the mel spectrum
     """
-
-    # Short time fourier transform across the signal
-    stfts = tf.signal.stft(signal,
-                           frame_length=frame_length,
-                           frame_step=frame_step,
-                           fft_length=fft_length)
-
-    # Turn into spectrograms
-    spectrograms = tf.abs(stfts)
-
-    # Calculate mel features
-    num_spectrogram_bins = stfts.shape[-1].value
-    linear_to_mel_weight_matrix = tf.signal.linear_to_mel_weight_matrix(
-        num_mel_bins=num_mel_bins, num_spectrogram_bins=num_spectrogram_bins,
-        sample_rate=sample_rate,
-        lower_edge_hertz=lower_edge_hertz,
-        upper_edge_hertz=upper_edge_hertz)
-    mel_spectrograms = tf.tensordot(
-        spectrograms, linear_to_mel_weight_matrix, 1)
-    mel_spectrograms.set_shape(spectrograms.shape[:-1].concatenate(
-        linear_to_mel_weight_matrix.shape[-1:]))
-
-    return mel_spectrograms
+    extractor = FeatureExtractor(sample_rate=sample_rate,
+                                 frame_length=frame_length,
+                                 frame_step=frame_step,
+                                 fft_length=fft_length,
+                                 lower_edge_hertz=lower_edge_hertz,
+                                 upper_edge_hertz=upper_edge_hertz,
+                                 num_mel_bins=num_mel_bins)
+
+    return extractor.features(signal, ["mel"])["mel"]
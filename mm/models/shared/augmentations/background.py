@@ -1,7 +1,7 @@
 """Download sounds from https://www.soundsnap.com/."""
 import numpy as np
 import pathlib
-import sox
+import shared.audio_io as audio_io
 
 
 from models.shared.augmentations.core import Augmentation
@@ -25,12 +25,9 @@ class Background(Augmentation):
 
         self.noises, self.density = [], []
 
-        transformer = sox.Transformer()
-        transformer.set_output_format(rate=sample_rate, channels=1)
         for file in background_noises.glob("*.mp3"):
             print(f"Loading background noise {file}")
-            resampled_audio = transformer.build_array(
-                input_filepath=str(file), sample_rate_in=sample_rate)
+            resampled_audio = audio_io.read(file, sample_rate)
 
             self.noises.append(resampled_audio)
             self.density.append(len(resampled_audio))
@@ -0,0 +1,173 @@
+"""Nearest neighbour search over stored keyword embeddings.
+
+Embeddings are l2 normalized, as they are in exported models, so both distances can
+be computed from squared euclidean distances: cosine = |a - b|^2 / 2.
+
+FlatIndex computes exact distances to every stored embedding. ProductQuantizedIndex
+splits embeddings into subspaces and stores a one byte centroid code per subspace,
+distances are approximated from per query lookup tables of the centroid distances.
+"""
+import numpy as np
+from enum import Enum
+from typing import Tuple
+
+
+class Aggregate(Enum):
+    VOTE = "vote"
+    MEAN = "mean"
+
+
+def l2_normalize(x: np.ndarray) -> np.ndarray:
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def squared_to_distance(distance: str, squared: np.ndarray) -> np.ndarray:
+    squared = np.maximum(squared, 0.0)
+    if distance == "cosine":
+        return squared / 2
+
+    return np.sqrt(squared)
+
+
+def top_k(distances: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    """The k smallest distances [Q, k] of each row and their indices, closest first."""
+    k = min(k, distances.shape[1])
+    ids = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    nearest = np.take_along_axis(distances, ids, axis=1)
+
+    order = np.argsort(nearest, axis=1)
+    return np.take_along_axis(nearest, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def keyword_scores(distances: np.ndarray,
+                   labels: np.ndarray,
+                   num_keywords: int,
+                   aggregate: Aggregate) -> Tuple[np.ndarray, np.ndarray]:
+    """Aggregates the distances [Q, k] of the nearest neighbours with keyword 'labels' [Q, k].
+
+    Returns the best keyword [Q] and its mean neighbour distance [Q]. With Aggregate.VOTE the keyword
+    with the most neighbours wins and ties go to the smallest mean distance, with Aggregate.MEAN the
+    smallest mean distance wins.
+    """
+    one_hot = np.eye(num_keywords, dtype=np.float32)[labels]
+    votes = one_hot.sum(axis=1)
+    mean = np.einsum("qkw,qk->qw", one_hot, distances) / np.maximum(votes, 1)
+
+    if aggregate == Aggregate.VOTE:
+        # Distances of normalized embeddings are at most 2, so a mean never outweighs a vote
+        score = votes - mean / 4
+    else:
+        score = np.where(votes > 0, -mean, -np.inf)
+
+    keyword = np.argmax(score, axis=1)
+    return keyword, mean[np.arange(len(keyword)), keyword]
+
+
+class FlatIndex:
+    """Exact search, the same distances as the dense argmin of exported models."""
+
+    def __init__(self, embeddings: np.ndarray, labels: np.ndarray, distance: str = "cosine"):
+        self.embeddings = l2_normalize(np.asarray(embeddings, dtype=np.float32))
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.num_keywords = int(self.labels.max()) + 1 if len(self.labels) else 0
+        self.distance = distance
+
+        self.squared_norms = np.sum(np.square(self.embeddings), axis=1)
+
+    def __len__(self):
+        return len(self.embeddings)
+
+    def distances(self, queries: np.ndarray) -> np.ndarray:
+        queries = l2_normalize(np.asarray(queries, dtype=np.float32))
+
+        squared = np.sum(np.square(queries), axis=1, keepdims=True) \
+            - 2 * queries @ self.embeddings.T \
+            + self.squared_norms
+        return squared_to_distance(self.distance, squared)
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Distances [Q, k] and indices [Q, k] of the k nearest stored embeddings of each query."""
+        return top_k(self.distances(queries), k)
+
+    def keywords(self, queries: np.ndarray, k: int, aggregate: Aggregate = Aggregate.VOTE):
+        """Keyword [Q] and its mean distance [Q] from the k nearest stored embeddings of each query."""
+        distances, ids = self.search(queries, k)
+        return keyword_scores(distances, self.labels[ids], self.num_keywords, aggregate)
+
+
+class ProductQuantizedIndex(FlatIndex):
+    """Approximate search over product quantized embeddings, uses D / subspaces times less memory per float."""
+
+    def __init__(self,
+                 embeddings: np.ndarray,
+                 labels: np.ndarray,
+                 distance: str = "cosine",
+                 subspaces: int = 16,
+                 centroids: int = 256,
+                 iterations: int = 20,
+                 seed: int = 0):
+        embeddings = l2_normalize(np.asarray(embeddings, dtype=np.float32))
+
+        if embeddings.shape[1] % subspaces:
+            raise ValueError(f"Embedding dimension {embeddings.shape[1]} is not divisible by {subspaces} subspaces")
+
+        if centroids > 256:
+            raise ValueError(f"At most 256 centroids fit in a one byte code, got {centroids}")
+
+        self.labels = np.asarray(labels, dtype=np.int64)
+        self.num_keywords = int(self.labels.max()) + 1 if len(self.labels) else 0
+        self.distance = distance
+        self.subspaces = subspaces
+
+        # [N, M, D / M]
+        sub_embeddings = embeddings.reshape([len(embeddings), subspaces, -1])
+
+        random = np.random.RandomState(seed)
+        self.codebooks = np.stack([kmeans(sub_embeddings[:, m], centroids, iterations, random)
+                                   for m in range(subspaces)])
+
+        # [N, M]
+        self.codes = np.stack([assign(sub_embeddings[:, m], self.codebooks[m])
+                               for m in range(subspaces)], axis=1).astype(np.uint8)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def distances(self, queries: np.ndarray) -> np.ndarray:
+        queries = l2_normalize(np.asarray(queries, dtype=np.float32))
+        sub_queries = queries.reshape([len(queries), self.subspaces, -1])
+
+        # [Q, M, C] squared distances from each query subvector to each centroid of its subspace
+        tables = np.sum(np.square(sub_queries[:, :, None] - self.codebooks[None]), axis=-1)
+
+        # [Q, N] sum over subspaces of the table entries of each code
+        squared = np.zeros([len(queries), len(self.codes)], dtype=np.float32)
+        for m in range(self.subspaces):
+            squared += tables[:, m, self.codes[:, m]]
+
+        return squared_to_distance(self.distance, squared)
+
+
+def assign(x: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    squared = np.sum(np.square(x), axis=1, keepdims=True) \
+        - 2 * x @ centroids.T \
+        + np.sum(np.square(centroids), axis=1)
+    return np.argmin(squared, axis=1)
+
+
+def kmeans(x: np.ndarray, centroids: int, iterations: int, random: np.random.RandomState) -> np.ndarray:
+    """Lloyd's algorithm, empty clusters keep their previous centroid."""
+    centroids = min(centroids, len(x))
+    means = x[random.choice(len(x), size=centroids, replace=False)]
+
+    for _ in range(iterations):
+        clusters = assign(x, means)
+
+        counts = np.bincount(clusters, minlength=centroids)
+        sums = np.zeros_like(means)
+        np.add.at(sums, clusters, x)
+
+        non_empty = counts > 0
+        means[non_empty] = sums[non_empty] / counts[non_empty, None]
+
+    return means
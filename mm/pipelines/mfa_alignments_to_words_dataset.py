@@ -3,74 +3,161 @@ import os
 
 sys.path.append(os.getcwd())
 
+import json
+import zlib
+import multiprocessing
 import numpy as np
 import textgrid
 import argparse
-import sox
 import pathlib
 import tensorflow as tf
+from pipelines.preprocessing.filter_on_length import acceptable_length
+from shared.utterance_store import UtteranceStoreWriter, META_FILE
+import shared.audio_io as audio_io
 from tqdm import tqdm
-from typing import Mapping
+from typing import List, Mapping, Set, Tuple, Union
 
+CHECKPOINT_FILE = "checkpoint.json"
 
-class Alignments:
-    def __init__(self):
-        self.word_counts = {}
 
+class AlignmentIndex:
+    """Columnar index of every aligned word, one row per word occurrence.
 
-def alignments_pass(alignments: pathlib.Path) -> Alignments:
-    """Peform a single pass on all alignments to calculate meta information."""
+    Parsing TextGrids is slow, so the index is built once and cached next to the alignments.
+    'position' is the index of the interval in its TextGrid.
+    """
+
+    def __init__(self,
+                 vocabulary: np.ndarray,
+                 speaker: np.ndarray,
+                 utterance: np.ndarray,
+                 word: np.ndarray,
+                 position: np.ndarray,
+                 start: np.ndarray,
+                 end: np.ndarray):
+        self.vocabulary = vocabulary
+        self.speaker = speaker
+        self.utterance = utterance
+        self.word = word
+        self.position = position
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return len(self.word)
+
+    @property
+    def word_counts(self) -> Mapping[str, int]:
+        counts = np.bincount(self.word, minlength=len(self.vocabulary))
+        return dict(zip(self.vocabulary.tolist(), counts.tolist()))
+
+    def save(self, path: pathlib.Path):
+        temporary = path.parent / f".{path.name}.tmp"
+        with open(str(temporary), "wb") as index_file:
+            np.savez(index_file, **self.__dict__)
+
+        os.replace(str(temporary), str(path))
+
+    @staticmethod
+    def load(path: pathlib.Path) -> "AlignmentIndex":
+        return AlignmentIndex(**np.load(str(path)))
+
+
+def get_speakers(alignments: pathlib.Path) -> List[pathlib.Path]:
+    # To ignore hidden files etc.
+    return sorted(speaker for speaker in alignments.glob("*") if str(speaker.stem).isnumeric())
+
+
+def _parse_speaker(speaker: pathlib.Path) -> List[Tuple[str, str, str, int, float, float]]:
+    rows = []
+    for grid in sorted(speaker.glob("*.TextGrid")):
+        tg = textgrid.TextGrid.fromFile(grid)
+        for position, interval in enumerate(tg[0]):
+            if interval.mark:
+                rows.append((speaker.name, grid.stem, interval.mark, position, interval.minTime, interval.maxTime))
+
+    return rows
+
+
+def alignments_pass(alignments: pathlib.Path, workers: int = 1) -> AlignmentIndex:
+    """Peform a single pass on all alignments to build the index of every word."""
+    speakers = get_speakers(alignments)
 
-    meta = Alignments()
+    if workers > 1:
+        with multiprocessing.Pool(processes=workers) as pool:
+            speaker_rows = list(tqdm(pool.imap(_parse_speaker, speakers), total=len(speakers), desc="Alignment Pass"))
+    else:
+        speaker_rows = [_parse_speaker(speaker) for speaker in tqdm(speakers, desc="Alignment Pass")]
+
+    rows = [row for rows in speaker_rows for row in rows]
+    speaker, utterance, text, position, start, end = zip(*rows) if rows else [[]] * 6
+
+    vocabulary, word = np.unique(np.array(text, dtype=str), return_inverse=True)
 
-    for speaker in tqdm(list(alignments.glob("*")), desc="Alignment Pass"):
+    return AlignmentIndex(vocabulary=vocabulary,
+                          speaker=np.array(speaker, dtype=str),
+                          utterance=np.array(utterance, dtype=str),
+                          word=word.astype(np.int32),
+                          position=np.array(position, dtype=np.int32),
+                          start=np.array(start, dtype=np.float64),
+                          end=np.array(end, dtype=np.float64))
 
-        # To ignore hidden files etc.
-        if str(speaker.stem).isnumeric():
-            for grid in speaker.glob("*.TextGrid"):
-                tg = textgrid.TextGrid.fromFile(grid)
-                for interval in tg[0]:
-                    text = interval.mark
 
-                    if text:
-                        if text not in meta.word_counts:
-                            meta.word_counts[text] = 0
+def load_alignments(alignments: pathlib.Path, index: pathlib.Path, reindex: bool, workers: int) -> AlignmentIndex:
+    """The cached index of the alignments, it is built if missing or if 'reindex' is set"""
+    if index.is_file() and not reindex:
+        print(f"Using alignment index {index}")
+        return AlignmentIndex.load(index)
 
-                        meta.word_counts[text] += 1
+    alignment_index = alignments_pass(alignments, workers)
+    alignment_index.save(index)
 
-    return meta
+    return alignment_index
 
 
 class Writers:
-    """Class containing the recordIO writers."""
+    """Class containing the recordIO writers.
+
+    Files are named after the utterance and position of the word in it, so writers in
+    different processes never collide and rewriting a speaker overwrites the same files.
+    """
 
     def __init__(self, 
-                 transformer: sox.Transformer,
                  base: pathlib.Path,
                  words: [str]):
-        self.transformer = transformer
         self.base = base
-        self.words = words
-        self.word_counts = {word: 0 for word in words}
+        self.words = set(words)
 
-    def __path(self, word: str):
+    def __path(self, word: str, name: str):
         output_dir = self.base / word
-        if not output_dir.is_dir():
-            os.makedirs(output_dir)
+        os.makedirs(output_dir, exist_ok=True)
+
+        return self.base / word / f"mfa_align-{name}.wav"
 
-        self.word_counts[word] += 1
-        return self.base / word / f"mfa_align-{self.word_counts[word]}.wav"
+    def write(self, word: str, name: str, sample_rate: int, audio: [int]):
+        output_path = self.__path(word, name)
 
-    def write(self, word: str, sample_rate: int, audio: [int]):
-        output_path = self.__path(word)
+        audio_io.write(output_path, audio, sample_rate)
 
-        self.transformer.build_file(
-            input_array=np.array(audio, dtype=np.int16), sample_rate_in=sample_rate,
-            output_filepath=str(output_path)
-        )
 
+class StoreClips:
+    """Collects the clips of a speaker in a worker, the main process appends them to an utterance store."""
 
-def get_words_to_convert(meta: Alignments,
+    def __init__(self, words: [str], clip_length: float):
+        self.words = set(words)
+        self.clip_length = clip_length
+        self.clips = []
+
+    def write(self, word: str, name: str, sample_rate: int, audio: [int]):
+        if acceptable_length(self.clip_length, 0, audio, sample_rate):
+            self.clips.append((word, np.array(audio, dtype=np.int16)))
+
+    def take(self) -> List[Tuple[str, np.ndarray]]:
+        clips, self.clips = self.clips, []
+        return clips
+
+
+def get_words_to_convert(meta: AlignmentIndex,
                          min_occurrences: int,
                          min_word_length: int) -> [str]:
     """The words to include in the common dataset"""
@@ -80,56 +167,169 @@ def get_words_to_convert(meta: Alignments,
             and len(word) >= min_word_length
             ]
 
-def create_datapoints(transformer: sox.Transformer,
+def create_datapoints(sample_rate: int,
                       writers: Writers,
-                      grid: pathlib.Path,
+                      speaker: str,
+                      utterance: str,
+                      words: [Tuple[str, int, float, float]],
                       audio: pathlib.Path):
-    """Creates datapoints from a TextGrid."""
-    audio_file = audio / grid.parts[-2] / f"{grid.stem}.wav"
+    """Creates datapoints from the (word, position, start, end) of an utterance."""
+    audio_file = audio / speaker / f"{utterance}.wav"
 
     if audio_file.is_file():
-        resampled_audio = transformer.build_array(
-            input_filepath=str(audio_file)
-        )
-
-        tg = textgrid.TextGrid.fromFile(grid)
-        for interval in tg[0]:
-            start_time = interval.minTime
-            end_time = interval.maxTime
-            text = interval.mark
+        resampled_audio = audio_io.read(audio_file, sample_rate)
 
-            if text in writers.word_counts:
-                start_sample = int(max((start_time - 0.1) * transformer.output_format["rate"], 0))
-                end_sample = int(min((end_time + 0.1) * transformer.output_format["rate"], resampled_audio.size))
+        for text, position, start_time, end_time in words:
+            start_sample = int(max((start_time - 0.1) * sample_rate, 0))
+            end_sample = int(min((end_time + 0.1) * sample_rate, resampled_audio.size))
 
-                utterance = resampled_audio[start_sample:end_sample]
+            utterance_audio = resampled_audio[start_sample:end_sample]
 
-                writers.write(word=text,
-                              sample_rate=transformer.output_format["rate"],
-                              audio=utterance)
+            writers.write(word=text,
+                          name=f"{speaker}-{utterance}-{position}",
+                          sample_rate=sample_rate,
+                          audio=utterance_audio)
 
     else:
         print(f"File not found: {audio_file}")
 
 
-def sample_pass(transformer: sox.Transformer,
-                writers: Writers,
+def words_fingerprint(words: [str]) -> int:
+    return zlib.crc32(json.dumps(sorted(words)).encode("utf-8"))
+
+
+def read_checkpoint(sink: pathlib.Path, words: [str], sample_rate: int, store: bool = False) -> Set[str]:
+    """Speakers that are already written to 'sink' by a run with the same words and sample rate.
+
+    A store records its speakers in its own meta, written together with its index.
+    """
+    path = sink / (META_FILE if store else CHECKPOINT_FILE)
+    if not path.is_file():
+        return set()
+
+    with open(str(path), "r") as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+
+    if checkpoint["words_fingerprint"] != words_fingerprint(words) or checkpoint["sample_rate"] != sample_rate:
+        raise ValueError(f"{sink} was written with other words or sample rate, remove it to start over")
+
+    return set(checkpoint["speakers"])
+
+
+def write_checkpoint(sink: pathlib.Path, words: [str], sample_rate: int, speakers: Set[str]):
+    os.makedirs(sink, exist_ok=True)
+
+    # Renamed into place so an interrupted write keeps the previous checkpoint
+    temporary = sink / f".{CHECKPOINT_FILE}.tmp"
+    with open(str(temporary), "w") as checkpoint_file:
+        json.dump({"words_fingerprint": words_fingerprint(words),
+                   "sample_rate": sample_rate,
+                   "speakers": sorted(speakers)}, checkpoint_file)
+
+    os.replace(str(temporary), str(sink / CHECKPOINT_FILE))
+
+
+_sample_rate: int = None
+_writers: Union[Writers, StoreClips] = None
+_audio: pathlib.Path = None
+
+
+def _init_speaker_pass(sample_rate: int, sink: pathlib.Path, words: [str], audio: pathlib.Path, clip_length: float):
+    global _sample_rate, _writers, _audio
+    _sample_rate = sample_rate
+    _writers = StoreClips(words, clip_length) if clip_length else Writers(sink, words)
+    _audio = audio
+
+
+def _speaker_pass(task: Tuple[str, Mapping[str, List[Tuple[str, int, float, float]]]]) \
+        -> Tuple[str, List[Tuple[str, np.ndarray]]]:
+    speaker, utterances = task
+    for utterance, words in utterances.items():
+        create_datapoints(sample_rate=_sample_rate,
+                          writers=_writers,
+                          speaker=speaker,
+                          utterance=utterance,
+                          words=words,
+                          audio=_audio)
+
+    if isinstance(_writers, StoreClips):
+        return speaker, _writers.take()
+
+    return speaker, []
+
+
+def speaker_tasks(index: AlignmentIndex, words: [str], done: Set[str]) -> List[Tuple[str, Mapping]]:
+    """The (speaker, {utterance: [(word, position, start, end)]}) to cut of every speaker that is not done"""
+    rows = np.flatnonzero(np.isin(index.vocabulary[index.word], words) & ~np.isin(index.speaker, list(done)))
+
+    tasks = {}
+    for i in rows:
+        utterances = tasks.setdefault(str(index.speaker[i]), {})
+        utterances.setdefault(str(index.utterance[i]), []).append(
+            (str(index.vocabulary[index.word[i]]), int(index.position[i]), float(index.start[i]), float(index.end[i])))
+
+    return sorted(tasks.items())
+
+
+def sample_pass(sample_rate: int,
+                sink: pathlib.Path,
                 words: [str],
                 audio: pathlib.Path,
-                alignments: pathlib.Path):
+                index: AlignmentIndex,
+                workers: int = 1,
+                store: bool = False,
+                clip_length: float = 2,
+                checkpoint_every: int = 20):
     """Perform a pass to sample data for the dataset.
 
-    During this pass the actual dataset is also created.
+    During this pass the actual dataset is also created. Speakers are processed in parallel by
+    'workers' processes and recorded in a checkpoint every 'checkpoint_every' speakers, so a rerun
+    skips them. With 'store' the words are appended to an utterance store in 'sink' instead of
+    written as wav files, words longer than 'clip_length' are dropped.
     """
-    for speaker in tqdm(list(alignments.glob("*")), desc="Dataset Pass"):
+    done = read_checkpoint(sink, words, sample_rate, store)
+    speakers = speaker_tasks(index, words, done)
+
+    print(f"Skipping {len(done)} speakers that are already done")
+
+    initargs = (sample_rate, sink, words, audio, clip_length if store else None)
+
+    store_writer = None
+    if store:
+        store_writer = UtteranceStoreWriter(sink,
+                                            sample_rate=sample_rate,
+                                            meta={"clip_length": clip_length,
+                                                  "words_fingerprint": words_fingerprint(words),
+                                                  "speakers": sorted(done)},
+                                            resume=bool(done))
+
+    def checkpoint():
+        # The done speakers of a store are written atomically with its index, so they always match its clips
+        if store_writer:
+            store_writer.checkpoint({"speakers": sorted(done)})
+        else:
+            write_checkpoint(sink, words, sample_rate, done)
+
+    def record(speaker_clips):
+        for i, (speaker, clips) in enumerate(tqdm(speaker_clips, total=len(speakers), desc="Dataset Pass")):
+            for word, clip in clips:
+                store_writer.append(word, clip)
+
+            done.add(speaker)
+            if (i + 1) % checkpoint_every == 0:
+                checkpoint()
+
+        checkpoint()
+
+    if workers > 1:
+        with multiprocessing.Pool(processes=workers, initializer=_init_speaker_pass, initargs=initargs) as pool:
+            record(pool.imap(_speaker_pass, speakers))
+    else:
+        _init_speaker_pass(*initargs)
+        record(map(_speaker_pass, speakers))
 
-        # To ignore hidden files etc.
-        if str(speaker.stem).isnumeric():
-            for grid in speaker.glob("*.TextGrid"):
-                create_datapoints(transformer=transformer,
-                                  writers=writers,
-                                  grid=grid,
-                                  audio=audio)
+    if store_writer:
+        store_writer.close()
 
 
 if __name__ == "__main__":
@@ -143,24 +343,36 @@ if __name__ == "__main__":
                         help="Minimum length of word")
     parser.add_argument("--sample_rate", type=int, default=8000,
                         help="Sample rate to convert data to.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes parsing and cutting speakers")
+    parser.add_argument("--alignment_index", type=pathlib.Path, default=None,
+                        help="Cached index of the alignments, defaults to 'index.npz' in --alignments")
+    parser.add_argument("--reindex", action="store_true", help="Rebuild the alignment index even if it is cached")
+    parser.add_argument("--store", action="store_true",
+                        help="Write an utterance store of packed int16 shards instead of a wav file per word")
+    parser.add_argument("--clip_length", type=float, default=2,
+                        help="Words longer than this (seconds) are left out of a --store")
+    parser.add_argument("--checkpoint_every", type=int, default=20,
+                        help="Number of speakers between checkpoints of the progress")
 
     args = parser.parse_args()
 
-    meta = alignments_pass(args.alignments)
+    meta = load_alignments(alignments=args.alignments,
+                           index=args.alignment_index or args.alignments / "index.npz",
+                           reindex=args.reindex,
+                           workers=args.workers)
     words = get_words_to_convert(meta,
                                  args.min_occurrences,
                                  args.min_word_length)
     print(f"N words: {len(words)} ")
 
-    transformer = sox.Transformer()
-    transformer.set_output_format(rate=args.sample_rate, channels=1)
-
-    writers = Writers(transformer, args.sink, words)
-
     sample_pass(
-        transformer=transformer,
-        writers=writers,
+        sample_rate=args.sample_rate,
+        sink=args.sink,
         words=words,
         audio=args.audio,
-        alignments=args.alignments
+        index=meta,
+        workers=args.workers,
+        store=args.store,
+        clip_length=args.clip_length,
+        checkpoint_every=args.checkpoint_every
     )
@@ -0,0 +1,131 @@
+"""Precomputes the MFCC features of a triplet dataset so training can skip the STFT."""
+import sys
+import os
+
+# Some systems dont use the launching directory as root
+sys.path.append(os.getcwd())
+
+import pathlib
+import argparse
+import tensorflow as tf
+import shared.tfexample_dma_utils as tfexample_dma_utils
+import models.shared.audio as audio
+import models.bulbasaur.bulbasaur as bulbasaur
+from shared.shard_manifest import write_manifest
+from shared.tfrecord import RECORD_FRAMING_BYTES
+from tqdm import tqdm
+
+tf.compat.v1.enable_eager_execution()
+
+
+def feature_dataset(files: [str], audio_length: int, sample_rate: int, batch_size: int) -> tf.data.Dataset:
+    feature_description = {
+        'anchor': tf.io.FixedLenFeature([], tf.string),
+        'positive': tf.io.FixedLenFeature([], tf.string),
+        'negative': tf.io.FixedLenFeature([], tf.string),
+        'anchor_text': tf.io.FixedLenFeature([], tf.string),
+        'positive_text': tf.io.FixedLenFeature([], tf.string),
+        'negative_text': tf.io.FixedLenFeature([], tf.string),
+    }
+
+    def extract_features(x):
+        x = tf.io.parse_example(x, feature_description)
+
+        for key in ["anchor", "positive", "negative"]:
+            signal = tf.reshape(tf.decode_raw(input_bytes=x[key], out_type=tf.int16), [-1, audio_length])
+            x[key] = tf.cast(bulbasaur.extract_audio_feature(signal=audio.normalize_audio(signal),
+                                                             sample_rate=sample_rate), tf.float16)
+
+        return x
+
+    dataset = tf.data.TFRecordDataset(filenames=files)
+    dataset = dataset.batch(batch_size=batch_size)
+    dataset = dataset.map(extract_features, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+    return dataset
+
+
+def run_features(source_prefix: str,
+                 sink_prefix: str,
+                 clip_length: float,
+                 sample_rate: int,
+                 examples_per_shard: int,
+                 batch_size: int):
+    entries = source_prefix.split("/")
+    path = "/".join(entries[:-1])
+    prefix = entries[-1]
+
+    files = [str(file) for file in pathlib.Path(path).glob(f"{prefix}")]
+
+    audio_length = int(clip_length * sample_rate)
+    fingerprint = bulbasaur.feature_fingerprint(sample_rate, audio_length)
+
+    shards = []
+    writer = None
+
+    for batch in tqdm(feature_dataset(files, audio_length, sample_rate, batch_size)):
+        batch = {key: value.numpy() for key, value in batch.items()}
+
+        for i in range(len(batch["anchor"])):
+            if writer is None or shards[-1]["records"] >= examples_per_shard:
+                if writer:
+                    writer.close()
+
+                file = f"{sink_prefix}-{len(shards)}"
+                shards.append({"file": os.path.basename(file), "records": 0, "bytes": 0})
+                writer = tf.io.TFRecordWriter(file)
+
+            example = tfexample_dma_utils.create_feature_example(fingerprint,
+                                                                 batch["anchor"][i],
+                                                                 batch["anchor_text"][i].decode("utf-8"),
+                                                                 batch["positive"][i],
+                                                                 batch["positive_text"][i].decode("utf-8"),
+                                                                 batch["negative"][i],
+                                                                 batch["negative_text"][i].decode("utf-8"))
+            example_bytes = example.SerializeToString()
+            writer.write(example_bytes)
+
+            shards[-1]["records"] += 1
+            shards[-1]["bytes"] += len(example_bytes) + RECORD_FRAMING_BYTES
+
+    if writer:
+        writer.close()
+
+    write_manifest(sink_prefix, shards,
+                   features={**bulbasaur.feature_params(sample_rate), "audio_length": audio_length},
+                   feature_shape=bulbasaur.feature_shape(sample_rate, audio_length),
+                   feature_fingerprint=fingerprint)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source_prefix",
+                        type=str,
+                        help="Prefix of sharded triplet files",
+                        required=True)
+    parser.add_argument("--sink_prefix",
+                        type=str,
+                        help="Prefix of sharded feature files",
+                        required=True)
+    parser.add_argument('--clip_length', type=float,
+                        help="Length of audio in seconds",
+                        default=2)
+    parser.add_argument('--sample_rate', type=int,
+                        help="sample_rate of audio",
+                        default=16000)
+    parser.add_argument('--examples_per_shard', type=int,
+                        help="Number of examples to store per shard",
+                        default=1000)
+    parser.add_argument('--batch_size', type=int,
+                        help="Number of examples to compute features for at a time",
+                        default=256)
+
+    args = parser.parse_args()
+
+    run_features(source_prefix=args.source_prefix,
+                 sink_prefix=args.sink_prefix,
+                 clip_length=args.clip_length,
+                 sample_rate=args.sample_rate,
+                 examples_per_shard=args.examples_per_shard,
+                 batch_size=args.batch_size)
@@ -1,17 +1,33 @@
+"""Shuffles records across all shards of a prefix with bounded memory.
+
+Records are first scattered into temporary buckets on disk, either at random or by a hash of
+the record. Each bucket is then small enough to be shuffled in memory and is written as one
+output shard. Output shards are written to a temporary file and renamed into place, so an
+interrupted run never leaves a truncated shard.
+"""
 import sys
 import os
 
 # Some systems dont use the launching directory as root
 sys.path.append(os.getcwd())
 
+import math
+import zlib
+import shutil
 import pathlib
-from typing import List
-import tensorflow as tf
+import multiprocessing
+from enum import Enum
+from typing import List, Tuple
 import random
 import argparse
+from shared.shard_manifest import write_manifest, is_manifest
+from shared.tfrecord import TFRecordReader, TFRecordWriter, HEADER_BYTES, FOOTER_BYTES
 from tqdm import tqdm
 
-tf.compat.v1.enable_eager_execution()
+
+class Key(Enum):
+    RANDOM = "random"
+    HASH = "hash"
 
 
 def get_files_to_shuffle(source_prefix: str) -> List[pathlib.Path]:
@@ -20,31 +36,149 @@ def get_files_to_shuffle(source_prefix: str) -> List[pathlib.Path]:
     base_path = "/".join(p[:-1])
     glob_prefix = p[-1]
     files = []
-    for file in pathlib.Path(base_path).glob(glob_prefix):
-        if file.is_file():
+    for file in sorted(pathlib.Path(base_path).glob(glob_prefix)):
+        if file.is_file() and not is_manifest(file):
             files.append(file)
     return files
 
 
+def bucket_part(temp_dir: pathlib.Path, bucket: int, part: int) -> pathlib.Path:
+    return temp_dir / f"bucket-{bucket:05d}-part-{part:05d}"
+
+
+def scatter(job: Tuple[pathlib.Path, int, pathlib.Path, int, Key, int, int]):
+    """Scatters the records of one input file into a part of every bucket.
+
+    Frames are buffered per bucket and appended to the bucket parts when 'buffer_bytes' are
+    buffered in total, so only one file is open at a time.
+    """
+    file, part, temp_dir, buckets, key, seed, buffer_bytes = job
+    rng = random.Random(f"{seed}-{part}")
+
+    buffers = [[] for _ in range(buckets)]
+    buffered = 0
+
+    def flush():
+        for bucket, frames in enumerate(buffers):
+            with TFRecordWriter(str(bucket_part(temp_dir, bucket, part)), append=True) as writer:
+                for frame in frames:
+                    writer.write_frame(frame)
+
+            frames.clear()
+
+    for _, frame in TFRecordReader(str(file)).frames():
+        if key == Key.HASH:
+            bucket = zlib.crc32(frame[HEADER_BYTES: -FOOTER_BYTES]) % buckets
+        else:
+            bucket = rng.randrange(buckets)
+
+        buffers[bucket].append(frame)
+        buffered += len(frame)
+
+        if buffered >= buffer_bytes:
+            flush()
+            buffered = 0
+
+    flush()
+
+
+def shuffle_bucket(job: Tuple[int, pathlib.Path, int, str, int]) -> dict:
+    """Shuffles one bucket in memory and writes it as an output shard"""
+    bucket, temp_dir, parts, sink_prefix, seed = job
+    rng = random.Random(f"{seed}-bucket-{bucket}")
+
+    frames = []
+    for part in range(parts):
+        frames.extend(frame for _, frame in TFRecordReader(str(bucket_part(temp_dir, bucket, part))).frames())
+
+    rng.shuffle(frames)
+
+    shard = f"{sink_prefix}-{bucket:05d}"
+    temporary_shard = f"{shard}.tmp"
+    with TFRecordWriter(temporary_shard) as writer:
+        for frame in frames:
+            writer.write_frame(frame)
+
+    os.replace(temporary_shard, shard)
+
+    for part in range(parts):
+        os.remove(str(bucket_part(temp_dir, bucket, part)))
+
+    return {"file": os.path.basename(shard),
+            "records": len(frames),
+            "bytes": sum(len(frame) for frame in frames)}
+
+
+def run_shuffle(source_prefix: str,
+                sink_prefix: str,
+                key: Key,
+                memory_mb: int,
+                workers: int,
+                seed: int = None,
+                temp_dir: pathlib.Path = None):
+    """Shuffles all records of 'source_prefix' into shards of 'sink_prefix'.
+
+    The number of buckets is chosen so that 'workers' buckets fit in 'memory_mb' at once, every bucket
+    becomes one output shard. With Key.HASH a record always lands in the same bucket.
+    """
+    files = get_files_to_shuffle(source_prefix)
+    if seed is None:
+        seed = random.getrandbits(32)
+
+    total_bytes = sum(file.stat().st_size for file in files)
+    buckets = max(math.ceil(total_bytes * workers / (memory_mb * 1e6)), 1)
+
+    # Bucket parts are appended to, so parts of an interrupted run are removed
+    temp_dir = temp_dir or pathlib.Path(f"{sink_prefix}.shuffle-tmp")
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+
+    print(f"Shuffling {len(files)} files ({total_bytes / 1e6:.1f} MB) through {buckets} buckets")
+
+    # Scatter buffers share the memory with the buckets
+    buffer_bytes = int(memory_mb * 1e6 / workers)
+
+    scatter_jobs = [(file, part, temp_dir, buckets, key, seed, buffer_bytes) for part, file in enumerate(files)]
+    bucket_jobs = [(bucket, temp_dir, len(files), sink_prefix, seed) for bucket in range(buckets)]
+
+    with multiprocessing.Pool(processes=workers) as pool:
+        for _ in tqdm(pool.imap_unordered(scatter, scatter_jobs), total=len(scatter_jobs), desc="Scatter"):
+            pass
+
+        shards = list(tqdm(pool.imap(shuffle_bucket, bucket_jobs), total=len(bucket_jobs), desc="Shuffle"))
+
+    shutil.rmtree(temp_dir)
+
+    write_manifest(sink_prefix, shards, key=key.value, seed=seed)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("--source",
                         type=str,
                         help="Prefix of sharded file",
                         required=True)
+    parser.add_argument("--sink_prefix",
+                        type=str,
+                        help="Prefix of the shuffled shards",
+                        required=True)
+    parser.add_argument("--key",
+                        default=Key.RANDOM.value,
+                        choices=[x.value for x in Key],
+                        help="Scatter records into buckets at random or by a hash of the record")
+    parser.add_argument("--memory_mb", type=int, default=2000,
+                        help="Approximate memory of the records shuffled in memory at once, over all workers")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes")
+    parser.add_argument("--seed", type=int, default=None, help="Seed to make the output reproducible")
+    parser.add_argument("--temp_dir", type=pathlib.Path, default=None,
+                        help="Directory of the temporary buckets, defaults to <sink_prefix>.shuffle-tmp")
 
     args = parser.parse_args()
 
-    files = get_files_to_shuffle(args.source)
-
-    # This only does 'within file' shuffling, the 'across file' shuffling is done by the preprocess.py file
-    with tqdm(total=len(files)) as progress_bar:
-        for file in files:
-            examples = [example.numpy() for example in tf.data.TFRecordDataset(filenames=[str(file)])]
-            random.shuffle(examples)
-
-            with tf.io.TFRecordWriter(str(file)) as writer:
-                for example in examples:
-                    writer.write(example)
-
-            progress_bar.update()
+    run_shuffle(source_prefix=args.source,
+                sink_prefix=args.sink_prefix,
+                key=Key(args.key),
+                memory_mb=args.memory_mb,
+                workers=args.workers,
+                seed=args.seed,
+                temp_dir=args.temp_dir)
@@ -6,82 +6,139 @@ import os
 sys.path.append(os.getcwd())
 
 import pathlib
-import tensorflow as tf
 import random
+import hashlib
 import argparse
 import logging
+import multiprocessing
+from enum import Enum
+from typing import Dict, List, Tuple
+from shared.shard_manifest import write_manifest, is_manifest
+from shared.tfrecord import TFRecordReader, TFRecordWriter, HEADER_BYTES, FOOTER_BYTES
 from tqdm import tqdm
 
-tf.compat.v1.enable_eager_execution()
-
 LOGGER_NAME = "TrainValidSplit"
+SPLITS = ["train", "valid"]
 
 
-def run_split(source_prefix: str, sink_prefix: str, examples_per_shard: int, train_fraction: float):
-    entries = source_prefix.split("/")
-    path = "/".join(entries[:-1])
-    prefix = entries[-1]
+class Key(Enum):
+    RANDOM = "random"
+    RECORD = "record"
+    WORD = "word"
+
+
+def anchor_text(record: bytes) -> bytes:
+    # Only parsing the example needs tensorflow
+    import tensorflow as tf
+
+    example = tf.train.Example()
+    example.ParseFromString(record)
+    return example.features.feature["anchor_text"].bytes_list.value[0]
+
+
+def in_train(key: bytes, salt: str, train_fraction: float) -> bool:
+    """Stable assignment of a key, the same key and salt always go to the same split"""
+    # blake2b keys are at most 64 bytes, so the salt of any length is digested into one
+    salt_key = hashlib.blake2b(salt.encode("utf-8")).digest()
+    digest = hashlib.blake2b(key, digest_size=8, key=salt_key).digest()
+    return int.from_bytes(digest, "little") / 2 ** 64 < train_fraction
+
 
-    files = list(pathlib.Path(path).glob(f"{prefix}"))
+class SplitWriter:
+    """Writes the shard sequence '<sink_prefix>.<split>-<group>-<index>' of one split"""
 
-    train_index = 0
-    valid_index = 0
+    def __init__(self, sink_prefix: str, split: str, group: int, examples_per_shard: int):
+        self.sink_prefix = sink_prefix
+        self.split = split
+        self.group = group
+        self.examples_per_shard = examples_per_shard
 
-    def next_train_file():
-        nonlocal train_index, sink_prefix
-        padding = 5 - len(str(train_index))
+        self.shards: List[Dict] = []
+        self.writer = None
 
-        file_name = f"{sink_prefix}.train-{'0' * padding}{train_index}"
-        train_index += 1
-        return file_name
+    def write_frame(self, frame: bytes):
+        if self.writer is None or self.shards[-1]["records"] >= self.examples_per_shard:
+            self.close()
 
-    def next_valid_file():
-        nonlocal valid_index, sink_prefix
-        padding = 5 - len(str(valid_index))
+            file_name = f"{self.sink_prefix}.{self.split}-{self.group:03d}-{len(self.shards):05d}"
+            self.shards.append({"file": os.path.basename(file_name), "split": self.split, "records": 0, "bytes": 0})
+            self.writer = TFRecordWriter(file_name)
 
-        file_name = f"{sink_prefix}.valid-{'0' * padding}{valid_index}"
-        valid_index += 1
-        return file_name
+        self.shards[-1]["records"] += 1
+        self.shards[-1]["bytes"] += self.writer.write_frame(frame)
 
-    train_file_entries = 0
-    valid_file_entries = 0
+    def close(self):
+        if self.writer:
+            self.writer.close()
 
-    train_file_writer = tf.io.TFRecordWriter(next_train_file())
-    valid_file_writer = tf.io.TFRecordWriter(next_valid_file())
 
-    total_train = 0
-    total_valid = 0
-    for file in tqdm(files):
-        for example in tf.data.TFRecordDataset(filenames=[str(file)]):
-            example = example.numpy()
+def split_files(job: Tuple[int, List[pathlib.Path], str, int, float, Key, str]) -> List[Dict]:
+    """Splits a group of files into its own train and valid shard sequences"""
+    group, files, sink_prefix, examples_per_shard, train_fraction, key, salt = job
+    rng = random.Random(f"{salt}-{group}")
 
-            if random.random() < train_fraction:
-                total_train += 1
+    writers = {split: SplitWriter(sink_prefix, split, group, examples_per_shard) for split in SPLITS}
 
-                train_file_entries += 1
-                train_file_writer.write(example)
+    for file in files:
+        # Records are copied with their framing, without decoding
+        for _, example in TFRecordReader(str(file)).frames():
+            if key == Key.RANDOM:
+                train = rng.random() < train_fraction
+            elif key == Key.RECORD:
+                train = in_train(example[HEADER_BYTES: -FOOTER_BYTES], salt, train_fraction)
             else:
-                total_valid += 1
+                # The positive is the anchor word, the negative may be a word of the other split
+                train = in_train(anchor_text(example[HEADER_BYTES: -FOOTER_BYTES]), salt, train_fraction)
+
+            writers["train" if train else "valid"].write_frame(example)
+
+    for writer in writers.values():
+        writer.close()
+
+    return writers["train"].shards + writers["valid"].shards
+
+
+def run_split(source_prefix: str,
+              sink_prefix: str,
+              examples_per_shard: int,
+              train_fraction: float,
+              key: Key = Key.RANDOM,
+              salt: str = "",
+              workers: int = 1):
+    """Splits the records of 'source_prefix' into train and valid shards.
+
+    With Key.RECORD or Key.WORD the split of a record is a stable hash of the record or of its anchor word,
+    so the same split is recreated from the same data anywhere. With Key.WORD an anchor word is never in
+    both splits, negatives can be words of the other split.
+    The files are split by 'workers' processes, each writing its own sequence of shards.
+    """
+    entries = source_prefix.split("/")
+    path = "/".join(entries[:-1])
+    prefix = entries[-1]
 
-                valid_file_entries += 1
-                valid_file_writer.write(example)
+    files = sorted(file for file in pathlib.Path(path).glob(f"{prefix}")
+                   if file.is_file() and not is_manifest(file))
 
-            if train_file_entries >= examples_per_shard:
-                train_file_entries = 0
-                train_file_writer.close()
+    jobs = [(group, files[group::workers], sink_prefix, examples_per_shard, train_fraction, key, salt)
+            for group in range(min(workers, len(files)))]
 
-                train_file_writer = tf.io.TFRecordWriter(next_train_file())
+    if workers > 1:
+        with multiprocessing.Pool(processes=workers) as pool:
+            groups = list(tqdm(pool.imap(split_files, jobs), total=len(jobs)))
+    else:
+        groups = [split_files(job) for job in tqdm(jobs)]
 
-            if valid_file_entries >= examples_per_shard:
-                valid_file_entries = 0
-                valid_file_writer.close()
+    shards = [shard for group in groups for shard in group]
 
-                valid_file_writer = tf.io.TFRecordWriter(next_valid_file())
+    counts = {split: sum(shard["records"] for shard in shards if shard["split"] == split) for split in SPLITS}
 
-    train_file_writer.close()
-    valid_file_writer.close()
+    write_manifest(sink_prefix, shards,
+                   key=key.value,
+                   salt=salt,
+                   train_fraction=train_fraction,
+                   splits=counts)
 
-    logger.info(f"train_examples: {total_train} -- valid_examples: {total_valid}")
+    logging.getLogger(LOGGER_NAME).info(f"train_examples: {counts['train']} -- valid_examples: {counts['valid']}")
 
 
 if __name__ == '__main__':
@@ -103,13 +160,24 @@ if __name__ == '__main__':
     parser.add_argument('--train_fraction', type=float, dest="train_fraction",
                         help="fraction of data to train on",
                         default=0.8)
+    parser.add_argument("--key",
+                        default=Key.RANDOM.value,
+                        choices=[x.value for x in Key],
+                        help="Split at random, or by a stable hash of the record or of its anchor word")
+    parser.add_argument("--salt", type=str, default="",
+                        help="Salt of the hash, another salt gives another split")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes splitting files")
 
     args = parser.parse_args()
     logger.info(f"Source Prefix: {args.source_prefix}")
     logger.info(f"Sink Prefix: {args.sink_prefix}")
     logger.info(f"Examples per shard: {args.examples_per_shard}")
     logger.info(f"Train fraction: {args.train_fraction}")
+    logger.info(f"Key: {args.key}")
 
     run_split(source_prefix=args.source_prefix, sink_prefix=args.sink_prefix,
               examples_per_shard=args.examples_per_shard,
-              train_fraction=args.train_fraction)
+              train_fraction=args.train_fraction,
+              key=Key(args.key),
+              salt=args.salt,
+              workers=args.workers)
@@ -9,13 +9,18 @@ import numpy as np
 import tensorflow as tf
 import argparse
 import shared.tfexample_dma_utils as tfexample_dma_utils
+import shared.audio_io as audio_io
+from shared.utterance_store import UtteranceStore, UtteranceStoreWriter, META_FILE
+from shared.shard_manifest import write_manifest
+from shared.tfrecord import RECORD_FRAMING_BYTES
+from pipelines.split import in_train, SPLITS
 import random
-import sox
+import multiprocessing
 from pipelines.preprocessing.filter_on_length import acceptable_length
 from pipelines.preprocessing.random_bipadding import bipadding
 from pipelines.preprocessing.audio_augmentations import AudioAugmentations
 from tqdm import tqdm
-from typing import Dict, List
+from typing import Dict, List, Iterator, Optional, Set, Union
 from pathlib import Path
 
 tf.compat.v1.enable_eager_execution()
@@ -31,7 +36,7 @@ class Utterances:
 
 def meta_pass(source: Path) -> Utterances:
     meta = Utterances()
-    for word in source.glob("*"):
+    for word in sorted(source.glob("*")):
         if word.stem.startswith("."):
             print("ignoring hidden file", word)
             continue
@@ -42,26 +47,59 @@ def meta_pass(source: Path) -> Utterances:
         if keyword not in meta.word_files:
             meta.word_files[keyword] = []
 
-        meta.word_files[keyword] = list(word.glob("*"))
+        meta.word_files[keyword] = sorted(word.glob("*"))
 
     meta.words = list(meta.word_files.keys())
 
     return meta
 
 
+def split_words(words: List[str], split: str, train_fraction: float, salt: str) -> Set[str]:
+    """The words of one split, hashed the same way as the anchor words by pipelines/split.py --key=word"""
+    return {word for word in words
+            if in_train(word.upper().encode("utf-8"), salt, train_fraction) == (split == "train")}
+
+
+def restrict_words(utterances: Utterances, words: Set[str]) -> Utterances:
+    restricted = Utterances()
+    restricted.word_files = {word: files for word, files in utterances.word_files.items() if word in words}
+    restricted.words = list(restricted.word_files.keys())
+    return restricted
+
+
 class Writers:
+    """Writes examples into expected_total_size // expected_file_size shards.
+
+    Shards are filled max_open_files at a time, every example goes to the least filled
+    open shard. A shard is closed once it holds expected_file_size MB.
+    """
 
-    def __init__(self, sink_prefix: str, expected_file_size: int, expected_total_size: int):
+    def __init__(self, sink_prefix: str, expected_file_size: int, expected_total_size: int, max_open_files: int = 16):
+        self.sink_prefix = sink_prefix
         self.expected_file_size = expected_file_size
         self.expected_total_size = expected_total_size
+        self.max_open_files = max_open_files
 
-        self.writers = [
-            tf.io.TFRecordWriter(f"{sink_prefix}-{i}")
-            for i in range(self.expected_total_size // self.expected_file_size)
-        ]
+        self.num_shards = max(self.expected_total_size // self.expected_file_size, 1)
+        self.shards: List[Dict] = []
+        self.writers: Dict[int, tf.io.TFRecordWriter] = {}
 
         self.written_mb = 0
 
+        self.__open_shards()
+
+    def __open_shards(self):
+        start = len(self.shards)
+        for shard in range(start, min(start + self.max_open_files, self.num_shards)):
+            file = f"{self.sink_prefix}-{shard}"
+
+            self.shards.append({"file": os.path.basename(file), "records": 0, "bytes": 0})
+            self.writers[shard] = tf.io.TFRecordWriter(file)
+
+    @property
+    def full(self) -> bool:
+        return not self.writers
+
     def write(self,
               sample_rate: int,
               anchor_audio: np.ndarray,
@@ -78,17 +116,40 @@ class Writers:
                                                      positive_text,
                                                      negative_audio,
                                                      negative_text)
-        example_bytes = example.SerializeToString()
+        return self.write_bytes(example.SerializeToString())
 
-        example_mbs = sys.getsizeof(example_bytes) / 1e6
-        self.written_mb += example_mbs
+    def write_bytes(self, example_bytes: bytes):
+        if self.full:
+            raise ValueError(f"All {self.num_shards} shards of {self.sink_prefix} are full")
+
+        shard = min(self.writers, key=lambda s: (self.shards[s]["bytes"], s))
+        self.writers[shard].write(example_bytes)
+
+        record_bytes = len(example_bytes) + RECORD_FRAMING_BYTES
+        self.shards[shard]["records"] += 1
+        self.shards[shard]["bytes"] += record_bytes
 
-        random.choice(self.writers).write(example_bytes)
+        if self.shards[shard]["bytes"] >= self.expected_file_size * 1e6:
+            self.writers.pop(shard).close()
+
+            if self.full:
+                self.__open_shards()
+
+        example_mbs = record_bytes / 1e6
+        self.written_mb += example_mbs
 
         return example_mbs
 
+    def close(self):
+        for writer in self.writers.values():
+            writer.close()
+
+        self.writers = {}
+
+        write_manifest(self.sink_prefix, self.shards)
+
 
-def sample_triplet(transformer: sox.Transformer, utterances: Utterances) -> ((np.ndarray, str), (np.ndarray, str), (np.ndarray, str)):
+def sample_triplet(sample_rate: int, utterances: Utterances) -> ((np.ndarray, str), (np.ndarray, str), (np.ndarray, str)):
     anchor = random.choice(utterances.words)
 
     negative = random.choice(utterances.words)
@@ -110,19 +171,13 @@ def sample_triplet(transformer: sox.Transformer, utterances: Utterances) -> ((np
    # print("negative file", negative_file)
 
     anchor_word = anchor_file.parent.stem
-    anchor_audio = transformer.build_array(
-        input_filepath=str(anchor_file)
-    )
+    anchor_audio = audio_io.read(anchor_file, sample_rate)
 
     positive_word = positive_file.parent.stem
-    positive_audio = transformer.build_array(
-        input_filepath=str(positive_file)
-    )
+    positive_audio = audio_io.read(positive_file, sample_rate)
 
     negative_word = negative_file.parent.stem
-    negative_audio = transformer.build_array(
-        input_filepath=str(negative_file)
-    )
+    negative_audio = audio_io.read(negative_file, sample_rate)
 
     #print("anchor-word", anchor_word)
     #print("positive-word", positive_word)
@@ -131,102 +186,266 @@ def sample_triplet(transformer: sox.Transformer, utterances: Utterances) -> ((np
     return (anchor_audio, anchor_word), (positive_audio, positive_word), (negative_audio, negative_word)
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--source",
-                        type=Path,
-                        help="Prefix of input sharded file",
-                        required=True)
-    parser.add_argument("--sink_prefix",
-                        type=str,
-                        help="Prefix of output sharded file",
-                        required=True)
-    parser.add_argument('--clip_length', type=float,
-                        help="All audio clips with length (seconds) longer than 'maximum_clip_length' will be chunked",
-                        default=2)
-    parser.add_argument('--sample_rate', type=int,
-                        help="sample_rate of audio",
-                        default=16000)
-    parser.add_argument("--expected_file_size", type=int, help="File size in MB",
-                        default=100)
-    parser.add_argument("--expected_total_size", type=int, help="File size in MB",
-                        default=1 * 1000)
+def store_pass(utterances: Utterances,
+               sink: Path,
+               clip_length: float,
+               sample_rate: int,
+               chunk_size: int = 256):
+    """Decode all utterances once into a store, utterances of unacceptable length are dropped.
 
-    parser.add_argument("--augmentations", action="store_true", help="If should use augmentations on audio")
+    Files are decoded 'chunk_size' at a time, so memory does not grow with the number of utterances of a word.
+    """
+    with UtteranceStoreWriter(sink, sample_rate=sample_rate, meta={"clip_length": clip_length}) as writer:
+        for word, files in tqdm(utterances.word_files.items(), desc="Store Pass"):
+            for start in range(0, len(files), chunk_size):
+                for audio in audio_io.read_batch(files[start: start + chunk_size], sample_rate):
+                    if acceptable_length(clip_length, 0, audio, sample_rate):
+                        writer.append(word, audio)
 
-    args = parser.parse_args()
 
-    positive_augmented = False
+def sample_store_triplet(store: UtteranceStore,
+                         anchor_words: List[int],
+                         negative_words: List[int]) -> ((np.ndarray, str), (np.ndarray, str), (np.ndarray, str)):
+    """Same as sample_triplet but reads views into a store, anchor_words are the words with at least two utterances."""
+    anchor = random.choice(anchor_words)
+
+    negative = random.choice(negative_words)
+    while negative == anchor:
+        negative = random.choice(negative_words)
+
+    anchor_index = random.randrange(store.counts[anchor])
+
+    # Any other utterance of the anchor word
+    positive_index = random.randrange(store.counts[anchor] - 1)
+    if positive_index >= anchor_index:
+        positive_index += 1
+
+    negative_index = random.randrange(store.counts[negative])
+
+    return (store.utterance(anchor, anchor_index), store.words[anchor]), \
+           (store.utterance(anchor, positive_index), store.words[anchor]), \
+           (store.utterance(negative, negative_index), store.words[negative])
 
-    if args.augmentations:
-        augmentations = AudioAugmentations(sample_rate=args.sample_rate)
 
-    def pn_map(audio: np.ndarray, text: str, positive: bool) -> (np.ndarray, str, bool):
-        global positive_augmented
-        if not acceptable_length(args.clip_length, 0, audio, args.sample_rate):
+class TripletSampler:
+    """Samples, pads and augments triplets.
+
+    The anchor and positive augmentations are coupled, if the positive was not augmented
+    the anchor always is. That way the anchor and positive are never the same clean clip.
+
+    If 'words' is given all three words of a triplet are sampled from them, e.g. the words of one split.
+    """
+
+    def __init__(self,
+                 utterances: Union[Utterances, UtteranceStore],
+                 clip_length: float,
+                 sample_rate: int,
+                 augmentations: bool,
+                 words: Optional[Set[str]] = None):
+        self.utterances = utterances
+        self.clip_length = clip_length
+        self.sample_rate = sample_rate
+        self.augmentations = AudioAugmentations(sample_rate=sample_rate) if augmentations else None
+
+        if isinstance(utterances, UtteranceStore):
+            self.negative_words = [i for i, word in enumerate(utterances.words) if words is None or word in words]
+            self.anchor_words = [i for i in self.negative_words if utterances.counts[i] >= 2]
+        elif words is not None:
+            self.utterances = restrict_words(utterances, words)
+
+        self.positive_augmented = False
+
+    def sample_triplet(self) -> ((np.ndarray, str), (np.ndarray, str), (np.ndarray, str)):
+        if isinstance(self.utterances, UtteranceStore):
+            return sample_store_triplet(self.utterances, self.anchor_words, self.negative_words)
+
+        return sample_triplet(self.sample_rate, self.utterances)
+
+    def pn_map(self, audio: np.ndarray, text: str, positive: bool) -> (np.ndarray, str, bool):
+        if not acceptable_length(self.clip_length, 0, audio, self.sample_rate):
             return (None, None, False)
 
-        audio = bipadding(args.clip_length, audio, args.sample_rate)
+        audio = bipadding(self.clip_length, audio, self.sample_rate)
         text = text.upper()
 
-        if args.augmentations and np.random.rand() < 0.5:
-            audio = augmentations.do(audio)
+        if self.augmentations and np.random.rand() < 0.5:
+            audio = self.augmentations.do(audio)
 
             if positive:
-                positive_augmented = True
+                self.positive_augmented = True
 
         return audio, text, True
 
-
-    def anchor_map(audio: np.ndarray, text: str) -> (np.ndarray, str, bool):
-        global positive_augmented
-        if not acceptable_length(args.clip_length, 0, audio, args.sample_rate):
+    def anchor_map(self, audio: np.ndarray, text: str) -> (np.ndarray, str, bool):
+        if not acceptable_length(self.clip_length, 0, audio, self.sample_rate):
             return (None, None, False)
 
-        audio = bipadding(args.clip_length, audio, args.sample_rate)
+        audio = bipadding(self.clip_length, audio, self.sample_rate)
         text = text.upper()
 
-        if args.augmentations:
-            if not positive_augmented:
-                audio = augmentations.do(audio)
+        if self.augmentations:
+            if not self.positive_augmented:
+                audio = self.augmentations.do(audio)
             elif np.random.rand() < 0.5:
-                audio = augmentations.do(audio)
-
-        positive_augmented = False
+                audio = self.augmentations.do(audio)
 
         return audio, text, True
 
-    transformer = sox.Transformer()
-    transformer.set_output_format(rate=args.sample_rate, channels=1)
+    def sample_example(self) -> bytes:
+        """Samples triplets until one of acceptable length is found and returns it serialized."""
+        while True:
+            (anchor_audio, anchor_text), \
+                (positive_audio, positive_text), \
+                (negative_audio, negative_text) = self.sample_triplet()
 
+            self.positive_augmented = False
+            (positive_audio, positive_text, positive_ok) = self.pn_map(positive_audio, positive_text, True)
+            (negative_audio, negative_text, negative_ok) = self.pn_map(negative_audio, negative_text, False)
+
+            (anchor_audio, anchor_text, anchor_ok) = self.anchor_map(anchor_audio, anchor_text)
+
+            if anchor_ok == positive_ok == negative_ok == True:
+                example = tfexample_dma_utils.create_example(self.sample_rate,
+                                                             anchor_audio,
+                                                             anchor_text,
+                                                             positive_audio,
+                                                             positive_text,
+                                                             negative_audio,
+                                                             negative_text)
+                return example.SerializeToString()
+
+
+# One sampler per worker process, created by the pool initializer
+_sampler: Optional[TripletSampler] = None
+
+
+def _init_sampler(utterances: Union[Utterances, UtteranceStore],
+                  clip_length: float,
+                  sample_rate: int,
+                  augmentations: bool,
+                  words: Optional[Set[str]]):
+    global _sampler
+    _sampler = TripletSampler(utterances=utterances,
+                              clip_length=clip_length,
+                              sample_rate=sample_rate,
+                              augmentations=augmentations,
+                              words=words)
+
+
+def _sample_example(seed: int) -> bytes:
+    # Every triplet gets its own seed so the output does not depend on which worker builds it
+    random.seed(seed)
+    np.random.seed(seed)
+    return _sampler.sample_example()
+
+
+def triplet_examples(utterances: Union[Utterances, UtteranceStore],
+                     clip_length: float,
+                     sample_rate: int,
+                     augmentations: bool,
+                     workers: int,
+                     seed: int = None,
+                     words: Optional[Set[str]] = None) -> Iterator[bytes]:
+    """Endless stream of serialized triplets, only of 'words' if given.
+
+    With workers > 1 the triplets are built by a process pool, the stream is ordered
+    so a given seed produces the same output for any number of workers.
+    """
+    seeds = random.Random(seed)
+    sampler_args = (utterances, clip_length, sample_rate, augmentations, words)
+
+    if workers > 1:
+        with multiprocessing.Pool(processes=workers, initializer=_init_sampler, initargs=sampler_args) as pool:
+            while True:
+                # Submit in rounds so the task queue stays bounded
+                round_seeds = [seeds.getrandbits(32) for _ in range(workers * 16)]
+                for example_bytes in pool.imap(_sample_example, round_seeds, chunksize=4):
+                    yield example_bytes
+    else:
+        _init_sampler(*sampler_args)
+        while True:
+            yield _sample_example(seeds.getrandbits(32))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source",
+                        type=Path,
+                        help="Prefix of input sharded file, not needed if --store exists")
+    parser.add_argument("--sink_prefix",
+                        type=str,
+                        help="Prefix of output sharded file",
+                        required=True)
+    parser.add_argument('--clip_length', type=float,
+                        help="All audio clips with length (seconds) longer than 'maximum_clip_length' will be chunked",
+                        default=2)
+    parser.add_argument('--sample_rate', type=int,
+                        help="sample_rate of audio",
+                        default=16000)
+    parser.add_argument("--expected_file_size", type=int, help="File size in MB",
+                        default=100)
+    parser.add_argument("--expected_total_size", type=int, help="File size in MB",
+                        default=1 * 1000)
+    parser.add_argument("--max_open_files", type=int, help="Number of shards written to at the same time",
+                        default=16)
+
+    parser.add_argument("--augmentations", action="store_true", help="If should use augmentations on audio")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes building triplets")
+    parser.add_argument("--seed", type=int, default=None, help="Seed to make the output reproducible")
+    parser.add_argument("--store", type=Path, default=None,
+                        help="Directory of decoded utterances to sample from, it is built from --source if missing")
+    parser.add_argument("--split", choices=SPLITS, default=None,
+                        help="Only build triplets of the words of this split, so no word is in both splits")
+    parser.add_argument("--train_fraction", type=float, default=0.8,
+                        help="Fraction of the words in the train split")
+    parser.add_argument("--salt", type=str, default="",
+                        help="Salt of the word hash of --split, another salt gives another split")
+
+    args = parser.parse_args()
+
+    if not args.source and not (args.store and (args.store / META_FILE).is_file()):
+        parser.error("--source is required unless --store is an existing store")
+
+    if args.store:
+        if not (args.store / META_FILE).is_file():
+            store_pass(utterances=meta_pass(args.source),
+                       sink=args.store,
+                       clip_length=args.clip_length,
+                       sample_rate=args.sample_rate)
+
+        utterances = UtteranceStore(args.store)
+
+        if utterances.sample_rate != args.sample_rate or utterances.meta["clip_length"] != args.clip_length:
+            raise ValueError(f"Store {args.store} was built with sample_rate={utterances.sample_rate} "
+                             f"clip_length={utterances.meta['clip_length']}")
+    else:
+        utterances = meta_pass(args.source)
+
+    words = None
+    if args.split:
+        words = split_words(utterances.words, args.split, args.train_fraction, args.salt)
+        if len(words) < 2:
+            parser.error(f"The {args.split} split has {len(words)} words, triplets need at least two")
+
+    examples = triplet_examples(utterances=utterances,
+                                clip_length=args.clip_length,
+                                sample_rate=args.sample_rate,
+                                augmentations=args.augmentations,
+                                workers=args.workers,
+                                seed=args.seed,
+                                words=words)
 
-    utterances = meta_pass(args.source)
     writers = Writers(sink_prefix=args.sink_prefix,
                       expected_file_size=args.expected_file_size,
-                      expected_total_size=args.expected_total_size)
+                      expected_total_size=args.expected_total_size,
+                      max_open_files=args.max_open_files)
 
     with tqdm(total=writers.expected_total_size) as progress_bar:
-        while writers.written_mb <= writers.expected_total_size:
-            (anchor_audio, anchor_text), \
-                (positive_audio, positive_text), \
-                (negative_audio, negative_text) = sample_triplet(transformer, utterances)
-
-            #try:
-            (positive_audio, positive_text, positive_ok) = pn_map(positive_audio, positive_text, True)
-            (negative_audio, negative_text, negative_ok) = pn_map(negative_audio, negative_text, False)
+        for example_bytes in examples:
+            if writers.full:
+                break
 
-            (anchor_audio, anchor_text, anchor_ok) = anchor_map(anchor_audio, anchor_text)
-
-            if anchor_ok == positive_ok == negative_ok == True:
-                written_mbs = writers.write(args.sample_rate,
-                                            anchor_audio,
-                                            anchor_text,
-                                            positive_audio,
-                                            positive_text,
-                                            negative_audio,
-                                            negative_text)
-
-                progress_bar.update(n=written_mbs)
-            # except Exception as e:
-                # print(f"triplet construction failed, reason: {e}")
+            progress_bar.update(n=writers.write_bytes(example_bytes))
 
+    examples.close()
+    writers.close()
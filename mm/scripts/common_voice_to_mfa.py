@@ -1,9 +1,18 @@
+import sys
+import os
+
+# Some systems dont use the launching directory as root
+sys.path.append(os.getcwd())
+
 import pathlib
-import sox
+import csv
 import argparse
-import os
+import collections
+import multiprocessing
 import pandas as pd
+import shared.audio_io as audio_io
 from tqdm import tqdm
+from typing import Iterator, Optional, Tuple
 
 def normalize_transcription(transcription):
     transcription = transcription.replace('"', '')
@@ -14,40 +23,87 @@ def normalize_transcription(transcription):
     transcription = transcription.replace("?", '')
     return transcription.upper()
 
-def convert_cv(transformer: sox.Transformer,
+COLUMNS = ["client_id", "path", "sentence"]
+
+
+def read_tsv(tsv: pathlib.Path, chunk_size: int) -> Iterator[pd.DataFrame]:
+    return pd.read_csv(tsv, delimiter="\t", usecols=COLUMNS, chunksize=chunk_size)
+
+
+def convert_clip(job: Tuple[int, str, str, str, pathlib.Path, pathlib.Path, str]) -> Optional[str]:
+    """Converts one clip and writes its transcription, returns the reason if it failed"""
+    sample_rate, client, audio, transcription, clips, sink, prefix = job
+
+    try:
+        speaker_sink = sink / client
+        os.makedirs(speaker_sink, exist_ok=True)
+
+        audio_without_stem = audio.split(".")[0]
+
+        input_audio_file = clips / audio
+
+        output_audio_file = speaker_sink / f"{prefix}-{audio_without_stem}.wav"
+        output_transcription_file = speaker_sink / f"{prefix}-{audio_without_stem}.lab"
+
+        with open(str(output_transcription_file), "w") as o:
+            o.write(normalize_transcription(transcription))
+
+        audio_io.write(output_audio_file, audio_io.read(input_audio_file, sample_rate), sample_rate)
+    except Exception as e:
+        return str(e)
+
+    return None
+
+
+def convert_cv(sample_rate: int,
                max_per_speaker: int,
                tsv: pathlib.Path,
                clips: pathlib.Path,
                sink: pathlib.Path,
-               prefix: str):
+               prefix: str,
+               failures: pathlib.Path,
+               workers: int = 1,
+               chunk_size: int = 10000):
+    """Converts the last 'max_per_speaker' clips of every speaker in 'tsv'.
 
-    meta = pd.read_csv(tsv, delimiter="\t")
+    The tsv is read in chunks of 'chunk_size' rows twice, first to count the clips of each speaker
+    and then to convert them, so memory does not grow with the size of the tsv. Clips that fail
+    are written to 'failures', which has the columns of the tsv and can be passed as --tsv to retry them.
+    """
+    clips_per_speaker = collections.Counter()
+    for chunk in read_tsv(tsv, chunk_size):
+        clips_per_speaker.update(chunk["client_id"])
 
-    for client, df in tqdm(meta.groupby(by="client_id")):
-        df = df.tail(max_per_speaker)
+    seen = collections.Counter()
+    converted, failed = 0, 0
 
-        speaker_sink = sink / client
+    with multiprocessing.Pool(processes=workers) as pool, open(str(failures), "w", newline="") as failures_file:
+        failures_writer = csv.writer(failures_file, delimiter="\t")
+        failures_writer.writerow(COLUMNS + ["reason"])
 
-        if not speaker_sink.is_dir():
-            os.makedirs(speaker_sink)
+        with tqdm(total=sum(min(count, max_per_speaker) for count in clips_per_speaker.values())) as progress_bar:
+            for chunk in read_tsv(tsv, chunk_size):
+                jobs = []
+                for client, audio, transcription in zip(chunk["client_id"], chunk["path"], chunk["sentence"]):
+                    seen[client] += 1
 
-        for audio, transcription in zip(df["path"], df["sentence"]):
+                    # The last 'max_per_speaker' clips of each speaker
+                    if seen[client] > clips_per_speaker[client] - max_per_speaker:
+                        jobs.append((sample_rate, client, audio, transcription, clips, sink, prefix))
 
-            try:
-                audio_without_stem = audio.split(".")[0]
+                for job, reason in zip(jobs, pool.imap(convert_clip, jobs, chunksize=16)):
+                    if reason is None:
+                        converted += 1
+                    else:
+                        _, client, audio, transcription, *_ = job
+                        print(f"Failed to convert audio {audio} with sentence {transcription} reason: {reason}")
 
-                input_audio_file = clips / audio
+                        failures_writer.writerow([client, audio, transcription, reason])
+                        failed += 1
 
-                output_audio_file = speaker_sink / f"{prefix}-{audio_without_stem}.wav"
-                output_transcription_file = speaker_sink / f"{prefix}-{audio_without_stem}.lab"
+                    progress_bar.update(1)
 
-                with open(str(output_transcription_file), "w") as o:
-                    transcription = normalize_transcription(transcription)
-                    o.write(transcription)
-
-                transformer.build_file(input_filepath=str(input_audio_file), output_filepath=str(output_audio_file))
-            except Exception as e:
-                print(f"Failed to convert audio {audio} with sentence {transcription} reason: {str(e)}")
+    print(f"Converted {converted} clips, {failed} failed and are listed in {failures}")
 
 
 if __name__ == "__main__":
@@ -58,10 +114,14 @@ if __name__ == "__main__":
     parser.add_argument("--prefix", type=str, help="prefix of dataset")
     parser.add_argument("--max_per_speaker", type=int, help="max data per speaker")
     parser.add_argument("--sample_rate", type=int, help="resampling rate", default=16000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes converting clips")
+    parser.add_argument("--chunk_size", type=int, default=10000, help="Number of tsv rows read at a time")
+    parser.add_argument("--failures", type=pathlib.Path, default=None,
+                        help="tsv of the clips that failed, defaults to <tsv>-failures.tsv next to --tsv")
 
     args = parser.parse_args()
 
-    transformer = sox.Transformer()
-    transformer.set_output_format(rate=args.sample_rate, channels=1)
-
-    convert_cv(transformer, args.max_per_speaker, args.tsv, args.clips, args.sink, args.prefix)
+    convert_cv(args.sample_rate, args.max_per_speaker, args.tsv, args.clips, args.sink, args.prefix,
+               failures=args.failures or args.tsv.with_name(f"{args.tsv.stem}-failures.tsv"),
+               workers=args.workers,
+               chunk_size=args.chunk_size)
@@ -1,8 +1,15 @@
+import sys
+import os
+
+# Some systems dont use the launching directory as root
+sys.path.append(os.getcwd())
+
 import pathlib
-import sox
 import argparse
-import os
+import multiprocessing
+import shared.audio_io as audio_io
 from tqdm import tqdm
+from typing import Tuple
 
 
 def locate_transcriptions(chapter_root: pathlib.Path):
@@ -14,50 +21,72 @@ def locate_transcriptions(chapter_root: pathlib.Path):
         return None
 
 
-def convert_chapter(path: pathlib.Path, sink: pathlib.Path, prefix: str,
-                    transformer: sox.Transformer):
+def is_written(path: pathlib.Path) -> bool:
+    return path.is_file() and path.stat().st_size > 0
+
+
+def convert_chapter(path: pathlib.Path, sink: pathlib.Path, prefix: str, skip_existing: bool = False) -> int:
+    """Converts the flac files of a chapter to wav with a .lab transcription each, returns the number converted"""
     transcriptions = locate_transcriptions(path)
 
-    if not sink.is_dir():
-        os.makedirs(sink)
+    os.makedirs(sink, exist_ok=True)
 
+    converted = 0
     if transcriptions:
         with open(str(transcriptions), "r") as transcriptions:
-            for line in transcriptions.readlines():
-                line = line.strip()
-                end_of_index = line.find(" ")
+            lines = [line.strip() for line in transcriptions.readlines() if line.strip()]
+
+        labels = {}
+        for line in lines:
+            end_of_index = line.find(" ")
 
-                file_name = line[:end_of_index].strip()
+            file_name = line[:end_of_index].strip()
+            labels[file_name] = line[end_of_index:].strip()
 
-                file_name_with_extension = file_name + ".flac"
+        # Labels are tiny, they are all written before any audio is decoded
+        for file_name, label in labels.items():
+            label_output_file = sink / f"{prefix}-{file_name}.lab"
 
-                audio_input_file = path / file_name_with_extension
+            if not (skip_existing and is_written(label_output_file)):
+                with open(str(label_output_file), "w") as label_file:
+                    label_file.write(label)
 
-                audio_output_file = sink / f"{prefix}-{file_name}.wav"
-                label_output_file = sink / f"{prefix}-{file_name}.lab"
+        for file_name in labels:
+            audio_input_file = path / f"{file_name}.flac"
+            audio_output_file = sink / f"{prefix}-{file_name}.wav"
 
-                label = line[end_of_index:].strip()
+            if skip_existing and is_written(audio_output_file):
+                continue
 
-                transformer.build_file(input_filepath=str(audio_input_file), output_filepath=str(audio_output_file))
+            # Renamed into place, so an interrupted run never leaves a partial file that looks written
+            temporary_file = sink / f".{prefix}-{file_name}.wav.tmp"
 
-                with open(str(label_output_file), "w") as label_file:
-                    label_file.write(label)
+            audio, sample_rate = audio_io.decode(audio_input_file)
+            audio_io.write(temporary_file, audio, sample_rate)
+            os.replace(str(temporary_file), str(audio_output_file))
 
+            converted += 1
 
-def convert_speaker(path: pathlib.Path, sink: pathlib.Path, prefix: str,
-                    transformer: sox.Transformer):
-    for chapter_path in path.glob("*"):
-        if str(chapter_path.stem).isnumeric():
-            convert_chapter(chapter_path, sink, prefix, transformer)
+    return converted
 
 
-def convert_speakers(path: pathlib.Path, sink: pathlib.Path, prefix: str):
-    transformer = sox.Transformer()
-    for speaker_path in tqdm(list(path.glob("*"))):
+def _convert_chapter(job: Tuple[pathlib.Path, pathlib.Path, str, bool]) -> int:
+    return convert_chapter(*job)
+
+
+def convert_speakers(path: pathlib.Path, sink: pathlib.Path, prefix: str, workers: int = 1,
+                     skip_existing: bool = False):
+    jobs = []
+    for speaker_path in sorted(path.glob("*")):
         if str(speaker_path.stem).isnumeric():
-            sub_sink = sink / speaker_path.stem
+            for chapter_path in sorted(speaker_path.glob("*")):
+                if str(chapter_path.stem).isnumeric():
+                    jobs.append((chapter_path, sink / speaker_path.stem, prefix, skip_existing))
+
+    with multiprocessing.Pool(processes=workers) as pool:
+        converted = sum(tqdm(pool.imap_unordered(_convert_chapter, jobs), total=len(jobs), desc="Chapters"))
 
-            convert_speaker(speaker_path, sub_sink, prefix, transformer)
+    print(f"Converted {converted} files")
 
 
 if __name__ == "__main__":
@@ -65,7 +94,10 @@ if __name__ == "__main__":
     parser.add_argument("--source", type=pathlib.Path, help="source librispeech dataset")
     parser.add_argument("--sink", type=pathlib.Path, help="where to write mfa dataset")
     parser.add_argument("--prefix", type=str, help="prefix of dataset")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes converting chapters")
+    parser.add_argument("--skip-existing", dest="skip_existing", action="store_true",
+                        help="Don't convert files that are already in the sink")
 
     args = parser.parse_args()
 
-    convert_speakers(args.source, args.sink, args.prefix)
+    convert_speakers(args.source, args.sink, args.prefix, workers=args.workers, skip_existing=args.skip_existing)
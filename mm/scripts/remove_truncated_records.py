@@ -1,33 +1,127 @@
-import argparse
-import tensorflow as tf
+"""Checks the TFRecord framing of every shard in a directory.
+
+Every frame is checked for truncation and, unless --no_verify is passed, for its length and payload
+checksums. Corrupt shards are reported with the byte offset of their first corrupt frame and can be
+repaired, keeping the valid records before the corruption, or removed. Manifests in the directory that
+list a repaired or removed shard are updated.
+"""
 import sys
 import os
+
+# Some systems dont use the launching directory as root
+sys.path.append(os.getcwd())
+
+import json
+import argparse
+import multiprocessing
+from enum import Enum
 from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from shared.shard_manifest import is_manifest, update_shards
+from shared.tfrecord import scan
 from tqdm import tqdm
-tf.compat.v1.enable_eager_execution()
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--source", type=Path, required=True)
 
-    args = parser.parse_args()
+class Action(Enum):
+    REPORT = "report"
+    REPAIR = "repair"
+    REMOVE = "remove"
+
+
+def repair(file: Path, valid_bytes: int):
+    """Replaces a shard by its valid prefix, renamed into place so the shard is never half written"""
+    temporary = file.parent / f".{file.name}.repair"
+
+    with open(str(file), "rb") as source, open(str(temporary), "wb") as sink:
+        remaining = valid_bytes
+        while remaining:
+            chunk = source.read(min(remaining, 2 ** 24))
+            sink.write(chunk)
+            remaining -= len(chunk)
+
+    os.replace(str(temporary), str(file))
+
+
+def check(job: Tuple[Path, bool, Action]) -> Dict:
+    file, verify, action = job
 
-    continue_dropping = False
-    for file in tqdm(list(args.source.glob("*"))):
-        try:
-            for i, example in enumerate(tf.data.TFRecordDataset(filenames=[str(file)])):
-                continue
-        except Exception as e:
-            if not continue_dropping:
-                print("got exception", e, file)
-                print("cont?")
-                if "y" not in input():
-                    sys.exit(0)
+    records, valid_bytes, error = scan(str(file), verify=verify)
+    result = {
+        "file": str(file),
+        "bytes": file.stat().st_size,
+        "records": records,
+    }
 
-                continue_dropping = True
+    if error:
+        result.update({
+            "corrupt_offset": error.offset,
+            "reason": error.reason,
+            "valid_bytes": valid_bytes,
+            "action": action.value,
+        })
 
-            os.remove(file)
+        if action == Action.REMOVE or (action == Action.REPAIR and records == 0):
+            os.remove(str(file))
+            result["action"] = Action.REMOVE.value
+        elif action == Action.REPAIR:
+            repair(file, valid_bytes)
 
+    return result
+
+
+def update_manifests(source: Path, changed: Dict[str, Optional[Dict]]) -> List[str]:
+    """Updates the manifests in 'source' listing a changed shard, returns the updated manifests"""
+    manifests = sorted(file for file in source.glob("manifest.*") if is_manifest(file))
+    return [str(manifest) for manifest in manifests if update_shards(str(manifest), changed)]
+
+
+def check_shards(source: Path, pattern: str, verify: bool, action: Action, workers: int) -> Dict:
+    # Shard manifests live next to the shards
+    files = sorted(file for file in source.glob(pattern) if file.is_file() and not is_manifest(file))
+
+    with multiprocessing.Pool(processes=workers) as pool:
+        results = list(tqdm(pool.imap(check, [(file, verify, action) for file in files]), total=len(files)))
+
+    corrupt = [result for result in results if "corrupt_offset" in result]
+
+    # Repaired shards keep their valid records, removed shards are dropped from the manifests
+    changed = {Path(result["file"]).name: {"records": result["records"], "bytes": result["valid_bytes"]}
+               if result["action"] == Action.REPAIR.value else None
+               for result in corrupt if result["action"] != Action.REPORT.value}
+
+    return {
+        "files": len(results),
+        "records": sum(result["records"] for result in results),
+        "corrupt_files": len(corrupt),
+        "verified_checksums": verify,
+        "corrupt": corrupt,
+        "updated_manifests": update_manifests(source, changed) if changed else [],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", type=Path, required=True, help="Directory of shards")
+    parser.add_argument("--pattern", type=str, default="*", help="Glob of the shards in --source")
+    parser.add_argument("--action",
+                        default=Action.REPORT.value,
+                        choices=[x.value for x in Action],
+                        help="Only report corrupt shards, repair them by keeping the records before the "
+                             "corruption, or remove them")
+    parser.add_argument("--no_verify", action="store_true", help="Only check the framing, not the checksums")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of processes checking shards")
+    parser.add_argument("--report", type=Path, default=None, help="Write the JSON report to this file")
+
+    args = parser.parse_args()
 
+    report = check_shards(source=args.source,
+                          pattern=args.pattern,
+                          verify=not args.no_verify,
+                          action=Action(args.action),
+                          workers=args.workers)
 
+    print(json.dumps(report, indent=2))
 
+    if args.report:
+        with open(str(args.report), "w") as report_file:
+            json.dump(report, report_file, indent=2)
@@ -0,0 +1,79 @@
+"""In-process audio decoding, resampling and encoding.
+
+Files are decoded with soundfile and resampled with a polyphase filter, so no sox process
+is started per file. Formats that soundfile can't read (mp3 with older libsndfile) are
+decoded by sox as a fallback. All audio is mono int16.
+"""
+import math
+import pathlib
+import numpy as np
+import soundfile
+import scipy.signal
+from multiprocessing.pool import ThreadPool
+from typing import Iterable, List, Tuple, Union
+
+Path = Union[str, pathlib.Path]
+
+
+def to_mono(audio: np.ndarray) -> np.ndarray:
+    """[T, channels] int16 to [T] int16"""
+    if audio.shape[1] == 1:
+        return audio[:, 0]
+
+    return np.mean(audio, axis=1, dtype=np.float32).astype(np.int16)
+
+
+def _sox_decode(path: Path) -> Tuple[np.ndarray, int]:
+    import sox
+
+    transformer = sox.Transformer()
+    transformer.set_output_format(channels=1, bits=16)
+
+    return transformer.build_array(input_filepath=str(path)).astype(np.int16), int(sox.file_info.sample_rate(str(path)))
+
+
+def decode(path: Path) -> Tuple[np.ndarray, int]:
+    """The samples and sample rate of an audio file"""
+    try:
+        audio, sample_rate = soundfile.read(str(path), dtype="int16", always_2d=True)
+    except RuntimeError:
+        # Not a format libsndfile can read
+        return _sox_decode(path)
+
+    return to_mono(audio), sample_rate
+
+
+def resample(audio: np.ndarray, sample_rate_in: int, sample_rate_out: int) -> np.ndarray:
+    """Polyphase resampling of int16 audio [..., T], a batch of equally long clips is resampled at once"""
+    if sample_rate_in == sample_rate_out:
+        return audio
+
+    gcd = math.gcd(sample_rate_in, sample_rate_out)
+    resampled = scipy.signal.resample_poly(audio.astype(np.float32),
+                                           up=sample_rate_out // gcd,
+                                           down=sample_rate_in // gcd,
+                                           axis=-1)
+
+    return np.clip(np.round(resampled), -2 ** 15, 2 ** 15 - 1).astype(np.int16)
+
+
+def read(path: Path, sample_rate: int) -> np.ndarray:
+    """Samples of an audio file at 'sample_rate'"""
+    audio, file_sample_rate = decode(path)
+    return resample(audio, file_sample_rate, sample_rate)
+
+
+def write(path: Path, audio: np.ndarray, sample_rate: int):
+    """Writes int16 samples as a 16 bit wav file"""
+    soundfile.write(str(path), np.asarray(audio, dtype=np.int16), sample_rate, subtype="PCM_16", format="WAV")
+
+
+def read_batch(paths: Iterable[Path], sample_rate: int, threads: int = 4) -> List[np.ndarray]:
+    """Samples of many files, libsndfile releases the GIL so they are decoded by 'threads' threads"""
+    with ThreadPool(threads) as pool:
+        return pool.map(lambda path: read(path, sample_rate), list(paths))
+
+
+def write_batch(paths: Iterable[Path], clips: Iterable[np.ndarray], sample_rate: int, threads: int = 4):
+    with ThreadPool(threads) as pool:
+        pool.starmap(lambda path, audio: write(path, audio, sample_rate), zip(paths, clips))
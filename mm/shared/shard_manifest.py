@@ -0,0 +1,74 @@
+"""Manifests listing the records and bytes of every shard written under a prefix.
+
+The manifest is stored next to the shards as 'manifest.<prefix>.json' so that
+globbing the prefix does not pick it up as a shard.
+"""
+import os
+import json
+from typing import Dict, List, Optional
+
+
+def is_manifest(path) -> bool:
+    """If a file found next to the shards is a manifest, globs of shards should skip these"""
+    name = os.path.basename(str(path))
+    return name.startswith("manifest.") and name.endswith(".json")
+
+
+def manifest_path(sink_prefix: str) -> str:
+    directory, prefix = os.path.split(sink_prefix)
+    return os.path.join(directory, f"manifest.{prefix}.json")
+
+
+def write_manifest(sink_prefix: str, shards: List[Dict], **meta):
+    """Writes a manifest, shards are dicts with the keys 'file', 'records' and 'bytes'."""
+    manifest = {
+        **meta,
+        "records": sum(shard["records"] for shard in shards),
+        "bytes": sum(shard["bytes"] for shard in shards),
+        "shards": shards
+    }
+
+    with open(manifest_path(sink_prefix), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+
+def update_shards(path: str, shards: Dict[str, Optional[Dict]]) -> bool:
+    """Replaces the entries of the given shard files in the manifest at 'path', None removes a shard.
+
+    The totals are recounted and the manifest is renamed into place. Returns if the manifest listed any of them.
+    """
+    with open(path, "r") as manifest_file:
+        manifest = json.load(manifest_file)
+
+    if not any(shard["file"] in shards for shard in manifest["shards"]):
+        return False
+
+    updated = []
+    for shard in manifest["shards"]:
+        if shard["file"] not in shards:
+            updated.append(shard)
+        elif shards[shard["file"]] is not None:
+            updated.append({**shard, **shards[shard["file"]]})
+
+    manifest.update({
+        "records": sum(shard["records"] for shard in updated),
+        "bytes": sum(shard["bytes"] for shard in updated),
+        "shards": updated
+    })
+
+    # Manifests of split shards also count the records per split
+    if "splits" in manifest:
+        manifest["splits"] = {split: sum(shard["records"] for shard in updated if shard.get("split") == split)
+                              for split in manifest["splits"]}
+
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    os.replace(temporary, path)
+    return True
+
+
+def read_manifest(sink_prefix: str) -> Dict:
+    with open(manifest_path(sink_prefix), "r") as manifest_file:
+        return json.load(manifest_file)
@@ -74,3 +74,39 @@ def create_example(
             ])))
 
     return tf.train.Example(features=features)
+
+
+def create_feature_example(
+        feature_fingerprint: int,
+        anchor_features: np.array,
+        anchor_text: str,
+        positive_features: np.array,
+        positive_text: str,
+        negative_features: np.array,
+        negative_text: str) -> tf.train.Example:
+
+    features = tf.train.Features(
+        feature=dict(
+            anchor=bytes_feature(
+                np.array(anchor_features, dtype=np.float16).tobytes()
+            ),
+            positive=bytes_feature(
+                np.array(positive_features, dtype=np.float16).tobytes()
+            ),
+            negative=bytes_feature(
+                np.array(negative_features, dtype=np.float16).tobytes()
+            ),
+            anchor_text=bytes_feature(
+                anchor_text.encode("utf-8")
+            ),
+            positive_text=bytes_feature(
+                positive_text.encode("utf-8")
+            ),
+            negative_text=bytes_feature(
+                negative_text.encode("utf-8")
+            ),
+            feature_fingerprint=int64list_feature([
+                int(feature_fingerprint)
+            ])))
+
+    return tf.train.Example(features=features)
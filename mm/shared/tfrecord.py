@@ -0,0 +1,148 @@
+"""Reads and writes TFRecord files without TensorFlow.
+
+A TFRecord file is a sequence of frames
+
+    uint64 length | uint32 masked crc32c of length | payload | uint32 masked crc32c of payload
+
+all little endian. Copying records between files does not need to parse or re-checksum them,
+so frames can be copied as they are with TFRecordWriter.write_frame. Files are read through mmap.
+
+crc32c comes from the 'crc32c' package when it is installed, otherwise a much slower pure Python
+version is used.
+"""
+import os
+import mmap
+import struct
+from typing import Iterator, Optional, Tuple
+
+# Every TFRecord is framed by a uint64 length and two uint32 masked crc32c
+HEADER_BYTES = 12
+FOOTER_BYTES = 4
+RECORD_FRAMING_BYTES = HEADER_BYTES + FOOTER_BYTES
+
+_LENGTH = struct.Struct("<Q")
+_CRC = struct.Struct("<I")
+_MASK_DELTA = 0xa282ead8
+
+try:
+    from crc32c import crc32c
+except ImportError:
+    # Bitwise table lookups in Python, a few MB/s
+    _TABLE = []
+    for _i in range(256):
+        _crc = _i
+        for _ in range(8):
+            _crc = (_crc >> 1) ^ 0x82f63b78 if _crc & 1 else _crc >> 1
+        _TABLE.append(_crc)
+
+    def crc32c(data: bytes) -> int:
+        crc = 0xffffffff
+        for byte in bytes(data):
+            crc = _TABLE[(crc ^ byte) & 0xff] ^ (crc >> 8)
+        return crc ^ 0xffffffff
+
+
+def masked_crc(data: bytes) -> int:
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + _MASK_DELTA) & 0xffffffff
+
+
+class CorruptRecordError(ValueError):
+    """A frame that is truncated or fails its checksum, 'offset' is the byte offset of the frame in the file"""
+
+    def __init__(self, path: str, offset: int, reason: str):
+        super().__init__(f"{path}: corrupt record at byte {offset}, {reason}")
+        self.path = path
+        self.offset = offset
+        self.reason = reason
+
+
+class TFRecordReader:
+    """Iterates the records of a file, with verify=True the checksums of every frame are checked."""
+
+    def __init__(self, path: str, verify: bool = False):
+        self.path = str(path)
+        self.verify = verify
+
+    def __iter__(self) -> Iterator[bytes]:
+        for _, frame in self.frames():
+            yield frame[HEADER_BYTES: -FOOTER_BYTES]
+
+    def frames(self) -> Iterator[Tuple[int, bytes]]:
+        """(offset, frame) of every record, the frame includes the length and checksums"""
+        size = os.path.getsize(self.path)
+        if size == 0:
+            return
+
+        with open(self.path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            offset = 0
+            while offset < size:
+                frame = self.__frame(mapped, offset, size)
+                yield offset, frame
+                offset += len(frame)
+
+    def __frame(self, mapped: mmap.mmap, offset: int, size: int) -> bytes:
+        if offset + HEADER_BYTES > size:
+            raise CorruptRecordError(self.path, offset, "truncated header")
+
+        length_bytes = mapped[offset: offset + 8]
+        length, = _LENGTH.unpack(length_bytes)
+
+        if self.verify and _CRC.unpack(mapped[offset + 8: offset + 12])[0] != masked_crc(length_bytes):
+            raise CorruptRecordError(self.path, offset, "length checksum mismatch")
+
+        end = offset + HEADER_BYTES + length + FOOTER_BYTES
+        if end > size:
+            raise CorruptRecordError(self.path, offset, "truncated payload")
+
+        frame = mapped[offset: end]
+        if self.verify and _CRC.unpack(frame[-FOOTER_BYTES:])[0] != masked_crc(frame[HEADER_BYTES: -FOOTER_BYTES]):
+            raise CorruptRecordError(self.path, offset, "payload checksum mismatch")
+
+        return frame
+
+
+def scan(path: str, verify: bool = True) -> Tuple[int, int, Optional[CorruptRecordError]]:
+    """(records, bytes) of the valid prefix of a file and the first corruption, if any"""
+    records, valid_bytes = 0, 0
+    try:
+        for offset, frame in TFRecordReader(path, verify=verify).frames():
+            records += 1
+            valid_bytes = offset + len(frame)
+    except CorruptRecordError as error:
+        return records, valid_bytes, error
+
+    return records, valid_bytes, None
+
+
+class TFRecordWriter:
+    """Buffered writer of TFRecord files, with append=True records are added to an existing file"""
+
+    def __init__(self, path: str, buffer_bytes: int = 2 ** 20, append: bool = False):
+        self.path = str(path)
+        self.file = open(self.path, "ab" if append else "wb", buffering=buffer_bytes)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, record: bytes) -> int:
+        """Frames and writes a record, returns the number of bytes written"""
+        length_bytes = _LENGTH.pack(len(record))
+
+        self.file.write(length_bytes)
+        self.file.write(_CRC.pack(masked_crc(length_bytes)))
+        self.file.write(record)
+        self.file.write(_CRC.pack(masked_crc(record)))
+
+        return HEADER_BYTES + len(record) + FOOTER_BYTES
+
+    def write_frame(self, frame: bytes) -> int:
+        """Writes an already framed record as it is, e.g. one from TFRecordReader.frames"""
+        self.file.write(frame)
+        return len(frame)
+
+    def close(self):
+        self.file.close()
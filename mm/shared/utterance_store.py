@@ -0,0 +1,221 @@
+"""Packed storage of decoded utterances.
+
+A store is a directory of raw int16 sample shards together with an index of
+(shard, offset, length) per utterance, grouped by word. Reading an utterance is
+a slice of a memory mapped shard, so no decoding or copying is needed.
+
+meta.json names the index file it belongs to and is renamed into place last, so
+a store always has a consistent meta and index, even after an interrupted write.
+"""
+import os
+import json
+import pathlib
+import numpy as np
+from typing import Dict, List, Iterator
+
+META_FILE = "meta.json"
+INDEX_FILE = "index.npz"
+
+
+def shard_name(shard: int) -> str:
+    return f"samples-{shard:05d}.int16"
+
+
+def index_name(version: int) -> str:
+    return f"index-{version:05d}.npz"
+
+
+class UtteranceStoreWriter:
+    """Appends utterances to a store, the index is written on close and on checkpoint.
+
+    With resume=True an existing store is opened for appending, samples written after its
+    last checkpoint are discarded. Everything in 'meta' is written together with the index,
+    so it can record progress that has to match the stored utterances.
+    """
+
+    def __init__(self,
+                 sink: pathlib.Path,
+                 sample_rate: int,
+                 max_shard_bytes: int = 2 ** 31,
+                 meta: Dict = None,
+                 resume: bool = False):
+        os.makedirs(sink, exist_ok=True)
+
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.max_shard_bytes = max_shard_bytes
+        self.meta = meta or {}
+
+        self.word_ids: Dict[str, int] = {}
+
+        self.shards: List[int] = []
+        self.offsets: List[int] = []
+        self.lengths: List[int] = []
+        self.words: List[int] = []
+
+        self.shard = 0
+        self.shard_samples = 0
+        self.index_version = 0
+
+        if resume and (sink / META_FILE).is_file():
+            self.__resume()
+        else:
+            self.file = open(self.sink / shard_name(self.shard), "wb")
+
+    def __resume(self):
+        with open(str(self.sink / META_FILE), "r") as meta_file:
+            meta = json.load(meta_file)
+
+        if meta["sample_rate"] != self.sample_rate:
+            raise ValueError(f"Store {self.sink} has sample_rate={meta['sample_rate']}, not {self.sample_rate}")
+
+        index = np.load(str(self.sink / meta.get("index", INDEX_FILE)))
+        counts = np.diff(index["word_start"])
+
+        self.word_ids = {word: i for i, word in enumerate(meta["words"])}
+        self.shards = index["shard"].tolist()
+        self.offsets = index["offset"].tolist()
+        self.lengths = index["length"].tolist()
+        self.words = np.repeat(np.arange(len(counts)), counts).tolist()
+
+        self.shard = meta["shards"] - 1
+        self.shard_samples = meta["shard_samples"]
+        self.index_version = meta.get("index_version", 0) + 1
+
+        path = self.sink / shard_name(self.shard)
+        os.truncate(str(path), self.shard_samples * 2)
+        self.file = open(path, "ab")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def append(self, word: str, audio: np.ndarray):
+        audio = np.asarray(audio, dtype=np.int16)
+
+        if self.shard_samples and (self.shard_samples + audio.size) * 2 > self.max_shard_bytes:
+            self.file.close()
+            self.shard += 1
+            self.shard_samples = 0
+            self.file = open(self.sink / shard_name(self.shard), "wb")
+
+        if word not in self.word_ids:
+            self.word_ids[word] = len(self.word_ids)
+
+        self.shards.append(self.shard)
+        self.offsets.append(self.shard_samples)
+        self.lengths.append(audio.size)
+        self.words.append(self.word_ids[word])
+
+        self.file.write(audio.tobytes())
+        self.shard_samples += audio.size
+
+    def checkpoint(self, meta: Dict = None):
+        """Writes the index of everything appended so far, a store resumed from here keeps it.
+
+        'meta' is merged into the meta of the store in the same write.
+        """
+        self.meta.update(meta or {})
+        self.file.flush()
+        self.__write_index()
+
+    def close(self):
+        self.file.close()
+        self.__write_index()
+
+    def __write_index(self):
+        # Words are stored in sorted order and utterances are grouped by word
+        words = sorted(self.word_ids)
+        rank = np.zeros(len(words), dtype=np.int64)
+        for i, word in enumerate(words):
+            rank[self.word_ids[word]] = i
+
+        word = rank[np.array(self.words, dtype=np.int64)]
+        order = np.argsort(word, kind="stable")
+
+        # A new index file per write, the meta switches to it when it is renamed into place
+        index_file = index_name(self.index_version)
+        np.savez(str(self.sink / index_file),
+                 shard=np.array(self.shards, dtype=np.int32)[order],
+                 offset=np.array(self.offsets, dtype=np.int64)[order],
+                 length=np.array(self.lengths, dtype=np.int64)[order],
+                 word_start=np.searchsorted(word[order], np.arange(len(words) + 1)))
+
+        temporary = self.sink / f".{META_FILE}.tmp"
+        with open(str(temporary), "w") as meta_file:
+            json.dump({**self.meta,
+                       "sample_rate": self.sample_rate,
+                       "shards": self.shard + 1,
+                       "shard_samples": self.shard_samples,
+                       "index": index_file,
+                       "index_version": self.index_version,
+                       "words": words}, meta_file)
+
+        os.replace(str(temporary), str(self.sink / META_FILE))
+
+        if self.index_version and (self.sink / index_name(self.index_version - 1)).is_file():
+            os.remove(str(self.sink / index_name(self.index_version - 1)))
+
+        self.index_version += 1
+
+
+class UtteranceStore:
+    """Read access to a store created by UtteranceStoreWriter."""
+
+    def __init__(self, source: pathlib.Path):
+        self.source = source
+
+        with open(str(source / META_FILE), "r") as meta_file:
+            self.meta = json.load(meta_file)
+
+        self.sample_rate: int = self.meta["sample_rate"]
+        self.words: List[str] = self.meta["words"]
+        self.word_index = {word: i for i, word in enumerate(self.words)}
+
+        index = np.load(str(source / self.meta.get("index", INDEX_FILE)))
+        self.shard = index["shard"]
+        self.offset = index["offset"]
+        self.length = index["length"]
+        self.word_start = index["word_start"]
+
+        self.counts = np.diff(self.word_start)
+
+        self._samples = None
+
+    def __getstate__(self):
+        # Memory maps are reopened by the process that unpickles the store
+        state = self.__dict__.copy()
+        state["_samples"] = None
+        return state
+
+    def __len__(self):
+        return len(self.length)
+
+    @property
+    def samples(self) -> List[np.ndarray]:
+        if self._samples is None:
+            self._samples = []
+            for shard in range(self.meta["shards"]):
+                path = self.source / shard_name(shard)
+                if path.stat().st_size:
+                    self._samples.append(np.memmap(str(path), dtype=np.int16, mode="r"))
+                else:
+                    self._samples.append(np.zeros(0, dtype=np.int16))
+
+        return self._samples
+
+    def utterance(self, word: int, i: int) -> np.ndarray:
+        """The i'th utterance of a word, as a read-only view into the store."""
+        return self.utterance_at(self.word_start[word] + i)
+
+    def utterance_at(self, u: int) -> np.ndarray:
+        """Utterance by its position in the store, utterances of a word are at word_start[word]:word_start[word + 1]."""
+        offset = self.offset[u]
+
+        return self.samples[self.shard[u]][offset: offset + self.length[u]]
+
+    def utterances(self, word: int) -> Iterator[np.ndarray]:
+        for i in range(self.counts[word]):
+            yield self.utterance(word, i)
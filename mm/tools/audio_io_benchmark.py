@@ -0,0 +1,50 @@
+"""Measures how many audio files per second sox and shared/audio_io decode and resample."""
+import sys
+import os
+
+# Some systems don't use the launching directory as root
+sys.path.append(os.getcwd())
+
+import time
+import json
+import pathlib
+import argparse
+import shared.audio_io as audio_io
+
+
+def files_per_second(decode, files: [pathlib.Path]) -> float:
+    timestamp = time.time()
+    decode(files)
+    return len(files) / (time.time() - timestamp)
+
+
+def sox_decode(files: [pathlib.Path], sample_rate: int):
+    import sox
+
+    transformer = sox.Transformer()
+    transformer.set_output_format(rate=sample_rate, channels=1)
+    for file in files:
+        transformer.build_array(input_filepath=str(file))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", type=pathlib.Path, required=True, help="Directory of audio files")
+    parser.add_argument("--pattern", type=str, default="**/*.wav", help="Glob of files in --source to decode")
+    parser.add_argument("--sample_rate", type=int, default=16000, help="Sample rate to resample to")
+    parser.add_argument("--max_files", type=int, default=1000)
+    parser.add_argument("--threads", type=int, default=4, help="Threads of the batch decode")
+
+    args = parser.parse_args()
+
+    files = sorted(args.source.glob(args.pattern))[:args.max_files]
+
+    results = {
+        "files": len(files),
+        "sox": files_per_second(lambda fs: sox_decode(fs, args.sample_rate), files),
+        "audio_io": files_per_second(lambda fs: [audio_io.read(f, args.sample_rate) for f in fs], files),
+        "audio_io_batch": files_per_second(lambda fs: audio_io.read_batch(fs, args.sample_rate, args.threads), files),
+    }
+    results["speedup"] = results["audio_io_batch"] / results["sox"]
+
+    print(json.dumps(results, indent=2))
@@ -0,0 +1,141 @@
+"""Measures latency, memory, FLOPs and parameters of an exported bulbasaur model."""
+import sys
+import os
+
+# Some systems don't use the launching directory as root
+sys.path.append(os.getcwd())
+
+import time
+import json
+import wave
+import resource
+import pathlib
+import argparse
+import numpy as np
+import tensorflow as tf
+from typing import List
+
+OUTPUTS = ["project:0", "distances:0", "min_distance:0", "output:0"]
+
+
+def load_recordings(recordings: pathlib.Path, audio_length: int) -> List[np.ndarray]:
+    """Mono 16 bit wav files, cut or zero padded to audio_length"""
+    clips = []
+    for file in sorted(recordings.glob("*.wav")):
+        with wave.open(str(file), "rb") as wav:
+            audio = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)[:audio_length]
+
+        clips.append(np.pad(audio, [0, audio_length - len(audio)]))
+
+    return clips
+
+
+def synthetic_clips(audio_length: int, num_clips: int) -> List[np.ndarray]:
+    return [np.random.randint(-2 ** 15, 2 ** 15, size=audio_length).astype(np.int16) for _ in range(num_clips)]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def graph_flops(session: tf.compat.v1.Session, feed_dict: dict) -> int:
+    """FLOPs of one run of the outputs.
+
+    The profiler skips ops with incomplete shapes, e.g. everything after the [None, L] 'batch_audio', so
+    the shapes are taken from the metadata of a traced run.
+    """
+    run_metadata = tf.compat.v1.RunMetadata()
+    session.run(OUTPUTS,
+                feed_dict=feed_dict,
+                options=tf.compat.v1.RunOptions(trace_level=tf.compat.v1.RunOptions.FULL_TRACE),
+                run_metadata=run_metadata)
+
+    profile = tf.compat.v1.profiler.profile(session.graph,
+                                            run_meta=run_metadata,
+                                            options=tf.compat.v1.profiler.ProfileOptionBuilder.float_operation())
+    return profile.total_float_ops
+
+
+def parameter_count(graph: tf.Graph) -> int:
+    return int(sum(np.prod(variable.shape.as_list()) for variable in graph.get_collection("variables")))
+
+
+def benchmark(export_dir: str,
+              recordings: pathlib.Path,
+              stored_embeddings: List[int],
+              warmup_runs: int,
+              runs: int) -> dict:
+    with tf.Graph().as_default() as graph, tf.compat.v1.Session() as session:
+        tf.compat.v1.saved_model.loader.load(session, [tf.saved_model.tag_constants.SERVING], export_dir)
+
+        audio_length = graph.get_tensor_by_name("audio:0").shape.as_list()[0]
+        embedding_dim = graph.get_tensor_by_name("embeddings:0").shape.as_list()[1]
+
+        clips = load_recordings(recordings, audio_length) if recordings else synthetic_clips(audio_length, 16)
+
+        report = {
+            "export_dir": export_dir,
+            "audio_length": audio_length,
+            "embedding_dim": embedding_dim,
+            "parameters": parameter_count(graph),
+            "load_peak_rss_mb": peak_rss_mb(),
+            "latency": []
+        }
+
+        for num_embeddings in stored_embeddings:
+            embeddings = np.random.normal(size=[num_embeddings, embedding_dim]).astype(np.float32)
+            embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+            def feed_dict(i: int) -> dict:
+                return {"audio:0": clips[i % len(clips)], "embeddings:0": embeddings}
+
+            def run(i: int):
+                session.run(OUTPUTS, feed_dict=feed_dict(i))
+
+            for i in range(warmup_runs):
+                run(i)
+
+            latencies = []
+            for i in range(runs):
+                timestamp = time.perf_counter()
+                run(i)
+                latencies.append((time.perf_counter() - timestamp) * 1e3)
+
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            report["latency"].append({
+                "stored_embeddings": num_embeddings,
+                "flops": graph_flops(session, feed_dict(0)),
+                "p50_ms": p50,
+                "p95_ms": p95,
+                "p99_ms": p99,
+                "peak_rss_mb": peak_rss_mb()
+            })
+
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--export_dir", type=str, required=True, help="Directory of an exported model")
+    parser.add_argument("--recordings", type=pathlib.Path, default=None,
+                        help="Directory of 16 bit wav files to feed, random audio is used if not set")
+    parser.add_argument("--stored_embeddings", type=str, default="1,10,100,1000",
+                        help="Comma separated numbers of stored embeddings to benchmark")
+    parser.add_argument("--warmup_runs", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--output", type=pathlib.Path, default=None, help="Write the JSON report to this file")
+
+    args = parser.parse_args()
+
+    report = benchmark(export_dir=args.export_dir,
+                       recordings=args.recordings,
+                       stored_embeddings=[int(n) for n in args.stored_embeddings.split(",")],
+                       warmup_runs=args.warmup_runs,
+                       runs=args.runs)
+
+    print(json.dumps(report, indent=2))
+
+    if args.output:
+        with open(str(args.output), "w") as output_file:
+            json.dump(report, output_file, indent=2)
@@ -0,0 +1,104 @@
+"""Measures bulbasaur training throughput with one batched forward pass vs one pass each for anchor/positive/negative."""
+import sys
+import os
+
+# Some systems don't use the launching directory as root
+sys.path.append(os.getcwd())
+
+import time
+import json
+import tempfile
+import argparse
+import tensorflow as tf
+import models.bulbasaur.bulbasaur as bulbasaur
+
+
+def random_features(batch_size: int, audio_length: int, num_words: int):
+    features = {}
+    for key in ["anchor", "positive", "negative"]:
+        features[key] = tf.cast(tf.random.uniform([batch_size, audio_length],
+                                                  minval=-2 ** 15,
+                                                  maxval=2 ** 15,
+                                                  dtype=tf.int32), tf.int16)
+
+        features[f"{key}_text"] = tf.as_string(tf.random.uniform([batch_size], maxval=num_words, dtype=tf.int32))
+
+    return features
+
+
+def benchmark(batched_forward_pass: bool,
+              distance: bulbasaur.Distance,
+              loss: bulbasaur.Loss,
+              embedding_dim: int,
+              batch_size: int,
+              audio_length: int,
+              sample_rate: int,
+              warmup_steps: int,
+              steps: int) -> dict:
+    with tf.Graph().as_default() as graph:
+        tf.compat.v1.train.create_global_step()
+
+        model_fn = bulbasaur.make_model_fn(distance=distance,
+                                           embedding_dim=embedding_dim,
+                                           summary_output_dir=tempfile.mkdtemp(),
+                                           loss=loss,
+                                           sample_rate=sample_rate,
+                                           batched_forward_pass=batched_forward_pass)
+
+        spec = model_fn(random_features(batch_size, audio_length, num_words=batch_size // 4),
+                        None,
+                        tf.estimator.ModeKeys.TRAIN,
+                        None,
+                        None)
+
+        graph_ops = len(graph.get_operations())
+
+        with tf.compat.v1.Session() as session:
+            session.run(tf.compat.v1.global_variables_initializer())
+
+            for _ in range(warmup_steps):
+                session.run(spec.train_op)
+
+            timestamp = time.time()
+            for _ in range(steps):
+                session.run(spec.train_op)
+            duration = time.time() - timestamp
+
+    return {
+        "batched_forward_pass": batched_forward_pass,
+        "graph_ops": graph_ops,
+        "steps_per_second": steps / duration,
+        "triplets_per_second": steps * batch_size / duration,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--distance", default=bulbasaur.Distance.COSINE.value,
+                        choices=[x.value for x in bulbasaur.Distance])
+    parser.add_argument("--loss", default=bulbasaur.Loss.TRIPLET.value,
+                        choices=[x.value for x in bulbasaur.Loss])
+    parser.add_argument("--embedding_dim", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--clip_length", type=float, default=2)
+    parser.add_argument("--sample_rate", type=int, default=16000)
+    parser.add_argument("--warmup_steps", type=int, default=5)
+    parser.add_argument("--steps", type=int, default=50)
+
+    args = parser.parse_args()
+
+    results = [benchmark(batched_forward_pass=batched,
+                         distance=bulbasaur.Distance(args.distance),
+                         loss=bulbasaur.Loss(args.loss),
+                         embedding_dim=args.embedding_dim,
+                         batch_size=args.batch_size,
+                         audio_length=int(args.clip_length * args.sample_rate),
+                         sample_rate=args.sample_rate,
+                         warmup_steps=args.warmup_steps,
+                         steps=args.steps) for batched in [False, True]]
+
+    print(json.dumps({
+        "separate": results[0],
+        "batched": results[1],
+        "speedup": results[1]["steps_per_second"] / results[0]["steps_per_second"]
+    }, indent=2))